@@ -0,0 +1,148 @@
+"""Persistent local cache of the Ego4D source videos.
+
+The videos are stored as <cache_dir>/<video_uid>-<etag>.mp4, so an object
+replaced on S3 is never served from a stale copy, and the least recently used
+ones are evicted once the cache grows beyond its budget. The cache can be
+shared by the preparation scripts, also when they run at the same time: the
+videos in use hold a shared lock and are never evicted.
+"""
+
+import fcntl
+import os
+import threading
+
+
+class VideoCache:
+    def __init__(self, cache_dir, max_gb=None):
+        self._cache_dir = cache_dir
+        self._max_bytes = None if max_gb is None else int(max_gb * 1024**3)
+        self._lock = threading.Lock()
+        self._pins = {}
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _video_filename(self, video_uid, etag):
+        etag = etag.strip('"')
+        return os.path.join(self._cache_dir, f"{video_uid}-{etag}.mp4")
+
+    def fetch(self, s3, video_uid, s3_bucket_name, s3_key, etag=None):
+        """Returns the local filename of a video, downloading it on a miss.
+
+        The video stays pinned, and cannot be evicted, until it is released.
+        """
+        if etag is None:
+            etag = s3.head_object(Bucket=s3_bucket_name, Key=s3_key)["ETag"]
+
+        video_filename = self._video_filename(video_uid, etag)
+
+        if self._pin(video_filename):
+            # The modification time orders the videos for the LRU eviction
+            os.utime(video_filename)
+        else:
+            partial_filename = (
+                f"{video_filename}.{os.getpid()}-{threading.get_ident()}.part"
+            )
+            try:
+                s3.download_file(s3_bucket_name, s3_key, partial_filename)
+                os.replace(partial_filename, video_filename)
+            finally:
+                if os.path.exists(partial_filename):
+                    os.remove(partial_filename)
+
+            if not self._pin(video_filename):
+                raise RuntimeError(f"{video_filename} was evicted after its download")
+
+        self.evict()
+
+        return video_filename
+
+    def lookup(self, video_uid, etag):
+        """Returns the local filename of a cached video, pinned until it is
+        released, or None on a miss."""
+        video_filename = self._video_filename(video_uid, etag)
+
+        if not self._pin(video_filename):
+            return None
+
+        os.utime(video_filename)
+        return video_filename
+
+    def _pin(self, video_filename):
+        """Takes a shared lock on a cached video, if it is on disk."""
+        try:
+            video_file = open(video_filename, "rb")
+        except FileNotFoundError:
+            return False
+
+        fcntl.flock(video_file, fcntl.LOCK_SH)
+
+        try:
+            pinned = (
+                os.fstat(video_file.fileno()).st_ino == os.stat(video_filename).st_ino
+            )
+        except FileNotFoundError:
+            pinned = False
+
+        if not pinned:
+            # The video was evicted while waiting for the lock
+            video_file.close()
+            return False
+
+        with self._lock:
+            self._pins.setdefault(video_filename, []).append(video_file)
+
+        return True
+
+    def release(self, video_filename):
+        """Unpins a video fetched from the cache, which keeps it on disk."""
+        with self._lock:
+            video_files = self._pins.get(video_filename)
+            if not video_files:
+                return
+            video_file = video_files.pop()
+            if not video_files:
+                del self._pins[video_filename]
+
+        video_file.close()
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used videos not in use beyond the budget."""
+        if self._max_bytes is None:
+            return
+
+        with self._lock:
+            videos = []
+            for filename in os.listdir(self._cache_dir):
+                if not filename.endswith(".mp4"):
+                    continue
+                video_filename = os.path.join(self._cache_dir, filename)
+                try:
+                    stat = os.stat(video_filename)
+                except FileNotFoundError:
+                    continue
+                videos.append((stat.st_mtime, stat.st_size, video_filename))
+
+            total_bytes = sum(video_size for _, video_size, _ in videos)
+
+            for _, video_size, video_filename in sorted(videos):
+                if total_bytes <= self._max_bytes:
+                    break
+                if self._try_remove(video_filename):
+                    total_bytes -= video_size
+
+    def _try_remove(self, video_filename):
+        try:
+            video_file = open(video_filename, "rb")
+        except FileNotFoundError:
+            return False
+
+        with video_file:
+            try:
+                fcntl.flock(video_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # The video is being trimmed, by this or another process
+                return False
+            os.remove(video_filename)
+
+        return True
@@ -0,0 +1,414 @@
+"""Ranged S3 reads fetching only the bytes of an MP4 video covering some segments.
+
+The index of the video (the sample tables of the moov box, or the sidx box of
+a fragmented MP4) is read with small range requests and maps every segment to
+the byte ranges of its samples, starting from the keyframe preceding it. Only
+the merged ranges are then fetched, concurrently, into a sparse local file of
+the size of the whole video. Every offset of the index stays valid, so the file
+can be trimmed like the original one as long as only the fetched segments are
+read.
+"""
+
+import os
+import struct
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds fetched before every segment, covering composition offsets and edit
+# lists, and after it, covering the read-ahead of the decoders (moviepy buffers
+# a few seconds of audio past the position being read)
+LEAD_MARGIN_SEC = 1.0
+TAIL_MARGIN_SEC = 5.0
+# The beginning of the video is always fetched, since it is decoded on open
+HEAD_SEC = 5.0
+# Byte ranges closer than this are fetched with a single request
+MERGE_GAP_BYTES = 1024**2
+# Size of the parts fetched concurrently
+PART_BYTES = 8 * 1024**2
+# Size of the first read, which usually covers the ftyp box and a faststart moov
+INITIAL_READ_BYTES = 64 * 1024
+# Top level boxes holding the samples, which are only fetched partially. Their
+# headers are always written, so the demuxers can skip over the missing bytes
+MEDIA_BOXES = {b"mdat", b"moof", b"free", b"skip"}
+
+
+def read_range(s3, s3_bucket_name, s3_key, start, end):
+    """Reads the [start, end) bytes of an S3 object."""
+    response = s3.get_object(
+        Bucket=s3_bucket_name, Key=s3_key, Range=f"bytes={start}-{end - 1}"
+    )
+    return response["Body"].read()
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yields the (type, payload start, end) of the boxes in data[start:end]."""
+    end = len(data) if end is None else end
+    offset = start
+
+    while offset + 8 <= end:
+        box_size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if box_size == 1:
+            (box_size,) = struct.unpack_from(">Q", data, offset + 8)
+            header_size = 16
+        elif box_size == 0:
+            box_size = end - offset
+        if box_size < header_size:
+            raise ValueError(f"Malformed {box_type} box")
+
+        yield box_type, offset + header_size, offset + box_size
+        offset += box_size
+
+
+def find_box(data, start, end, *box_path):
+    """Returns the (payload start, end) of the first box found along box_path."""
+    for box_type in box_path:
+        for child_type, child_start, child_end in iter_boxes(data, start, end):
+            if child_type == box_type:
+                start, end = child_start, child_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def read_top_level_boxes(s3, s3_bucket_name, s3_key, video_size):
+    """Returns the (type, offset, size) of the top level boxes and the bytes of
+    the ones not holding samples, or only the header of the others, indexed by
+    their offset."""
+    initial_data = read_range(
+        s3, s3_bucket_name, s3_key, 0, min(INITIAL_READ_BYTES, video_size)
+    )
+
+    boxes = []
+    box_data = {}
+    offset = 0
+
+    while offset + 8 <= video_size:
+        if offset + 16 <= len(initial_data):
+            header = initial_data[offset : offset + 16]
+        else:
+            header = read_range(
+                s3, s3_bucket_name, s3_key, offset, min(offset + 16, video_size)
+            )
+
+        box_size, box_type = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if box_size == 1:
+            (box_size,) = struct.unpack_from(">Q", header, 8)
+            header_size = 16
+        elif box_size == 0:
+            box_size = video_size - offset
+        if box_size < header_size:
+            raise ValueError(f"Malformed top level {box_type} box")
+
+        boxes.append((box_type, offset, box_size))
+        if box_type in MEDIA_BOXES:
+            box_data[offset] = header[:header_size]
+        offset += box_size
+
+    for box_type, offset, box_size in boxes:
+        if box_type in MEDIA_BOXES:
+            continue
+        if offset + box_size <= len(initial_data):
+            box_data[offset] = initial_data[offset : offset + box_size]
+        else:
+            box_data[offset] = read_range(
+                s3, s3_bucket_name, s3_key, offset, offset + box_size
+            )
+
+    return boxes, box_data
+
+
+def unpack_array(data, start, count, item_format):
+    return struct.unpack_from(f">{count}{item_format}", data, start)
+
+
+def parse_track(moov, start, end):
+    """Returns the timescale, handler and sample table of a trak box."""
+    mdhd = find_box(moov, start, end, b"mdia", b"mdhd")
+    hdlr = find_box(moov, start, end, b"mdia", b"hdlr")
+    stbl = find_box(moov, start, end, b"mdia", b"minf", b"stbl")
+    if mdhd is None or hdlr is None or stbl is None:
+        raise ValueError("Track without sample table")
+
+    version = moov[mdhd[0]]
+    (timescale,) = struct.unpack_from(
+        ">I", moov, mdhd[0] + (20 if version == 1 else 12)
+    )
+    handler = moov[hdlr[0] + 8 : hdlr[0] + 12]
+
+    tables = {
+        box_type: (box_start, box_end)
+        for box_type, box_start, box_end in iter_boxes(moov, *stbl)
+    }
+
+    # Decoding times of the samples
+    stts_start = tables[b"stts"][0]
+    (entry_count,) = struct.unpack_from(">I", moov, stts_start + 4)
+    stts = unpack_array(moov, stts_start + 8, 2 * entry_count, "I")
+    sample_times = []
+    time = 0
+    for sample_count, sample_delta in zip(stts[::2], stts[1::2]):
+        if sample_delta:
+            sample_times.extend(
+                range(time, time + sample_count * sample_delta, sample_delta)
+            )
+        else:
+            sample_times.extend([time] * sample_count)
+        time += sample_count * sample_delta
+
+    # Sizes of the samples
+    if b"stsz" in tables:
+        stsz_start = tables[b"stsz"][0]
+        sample_size, sample_count = struct.unpack_from(">II", moov, stsz_start + 4)
+        if sample_size:
+            sample_sizes = [sample_size] * sample_count
+        else:
+            sample_sizes = unpack_array(moov, stsz_start + 12, sample_count, "I")
+    elif b"stz2" in tables:
+        stz2_start = tables[b"stz2"][0]
+        field_size = moov[stz2_start + 7]
+        (sample_count,) = struct.unpack_from(">I", moov, stz2_start + 8)
+        if field_size == 4:
+            packed_sizes = moov[
+                stz2_start + 12 : stz2_start + 12 + (sample_count + 1) // 2
+            ]
+            sample_sizes = [
+                size for byte in packed_sizes for size in (byte >> 4, byte & 0x0F)
+            ][:sample_count]
+        else:
+            sample_sizes = unpack_array(
+                moov, stz2_start + 12, sample_count, {8: "B", 16: "H"}[field_size]
+            )
+    else:
+        raise ValueError("Track without sample sizes")
+
+    # Offsets of the chunks, and of the samples within them
+    if b"stco" in tables:
+        stco_start = tables[b"stco"][0]
+        (chunk_count,) = struct.unpack_from(">I", moov, stco_start + 4)
+        chunk_offsets = unpack_array(moov, stco_start + 8, chunk_count, "I")
+    else:
+        co64_start = tables[b"co64"][0]
+        (chunk_count,) = struct.unpack_from(">I", moov, co64_start + 4)
+        chunk_offsets = unpack_array(moov, co64_start + 8, chunk_count, "Q")
+
+    stsc_start = tables[b"stsc"][0]
+    (entry_count,) = struct.unpack_from(">I", moov, stsc_start + 4)
+    stsc = unpack_array(moov, stsc_start + 8, 3 * entry_count, "I")
+    first_chunks = stsc[::3] + (chunk_count + 1,)
+    samples_per_chunks = stsc[1::3]
+
+    sample_offsets = []
+    sample_index = 0
+    for run, samples_per_chunk in enumerate(samples_per_chunks):
+        for chunk in range(first_chunks[run], first_chunks[run + 1]):
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(samples_per_chunk):
+                if sample_index >= len(sample_sizes):
+                    break
+                sample_offsets.append(offset)
+                offset += sample_sizes[sample_index]
+                sample_index += 1
+
+    # Keyframes, every sample being one without a stss box
+    sync_samples = None
+    if b"stss" in tables:
+        stss_start = tables[b"stss"][0]
+        (entry_count,) = struct.unpack_from(">I", moov, stss_start + 4)
+        sync_samples = [
+            sample_number - 1
+            for sample_number in unpack_array(moov, stss_start + 8, entry_count, "I")
+        ]
+
+    sample_count = min(len(sample_times), len(sample_sizes), len(sample_offsets))
+
+    return {
+        "handler": handler,
+        "timescale": timescale,
+        "sample_times": sample_times[:sample_count],
+        "sample_offsets": sample_offsets[:sample_count],
+        "sample_sizes": sample_sizes[:sample_count],
+        "sync_samples": sync_samples,
+    }
+
+
+def track_byte_ranges(tracks, segments):
+    """Maps the segments to the byte ranges of the samples of all the tracks."""
+    video_track = next((track for track in tracks if track["handler"] == b"vide"), None)
+    if video_track is None:
+        raise ValueError("No video track")
+
+    byte_ranges = []
+
+    for start_sec, end_sec in segments:
+        start_sec = max(start_sec - LEAD_MARGIN_SEC, 0)
+        end_sec = end_sec + TAIL_MARGIN_SEC
+
+        # Decoding starts from the keyframe preceding the segment
+        video_times = video_track["sample_times"]
+        first_sample = max(
+            bisect_right(video_times, start_sec * video_track["timescale"]) - 1, 0
+        )
+        sync_samples = video_track["sync_samples"]
+        if sync_samples:
+            first_sample = sync_samples[
+                max(bisect_right(sync_samples, first_sample) - 1, 0)
+            ]
+        start_sec = min(start_sec, video_times[first_sample] / video_track["timescale"])
+
+        for track in tracks:
+            sample_times = track["sample_times"]
+            first_sample = bisect_left(sample_times, start_sec * track["timescale"])
+            last_sample = bisect_right(sample_times, end_sec * track["timescale"])
+
+            for sample in range(first_sample, last_sample):
+                sample_offset = track["sample_offsets"][sample]
+                byte_ranges.append(
+                    (sample_offset, sample_offset + track["sample_sizes"][sample])
+                )
+
+    return byte_ranges
+
+
+def sidx_byte_ranges(sidx, sidx_end, segments):
+    """Maps the segments to the byte ranges of the referenced subsegments."""
+    version = sidx[0]
+    (timescale,) = struct.unpack_from(">I", sidx, 8)
+    if version == 0:
+        earliest_time, first_offset = struct.unpack_from(">II", sidx, 12)
+        position = 20
+    else:
+        earliest_time, first_offset = struct.unpack_from(">QQ", sidx, 12)
+        position = 28
+    (reference_count,) = struct.unpack_from(">H", sidx, position + 2)
+    position += 4
+
+    subsegments = []
+    time = earliest_time
+    offset = sidx_end + first_offset
+    for _ in range(reference_count):
+        reference, duration, _ = struct.unpack_from(">III", sidx, position)
+        position += 12
+        if reference >> 31:
+            raise ValueError("Hierarchical sidx boxes are not supported")
+        reference_size = reference & 0x7FFFFFFF
+        subsegments.append(
+            (time / timescale, (time + duration) / timescale, offset, reference_size)
+        )
+        time += duration
+        offset += reference_size
+
+    byte_ranges = []
+
+    for start_sec, end_sec in segments:
+        start_sec = start_sec - LEAD_MARGIN_SEC
+        end_sec = end_sec + TAIL_MARGIN_SEC
+        for subsegment_start, subsegment_end, offset, reference_size in subsegments:
+            if subsegment_start <= end_sec and start_sec < subsegment_end:
+                byte_ranges.append((offset, offset + reference_size))
+
+    return byte_ranges
+
+
+def merge_byte_ranges(byte_ranges, merge_gap=MERGE_GAP_BYTES):
+    """Sorts the byte ranges and merges the ones closer than merge_gap."""
+    merged_ranges = []
+
+    for start, end in sorted(byte_ranges):
+        if merged_ranges and start <= merged_ranges[-1][1] + merge_gap:
+            merged_ranges[-1][1] = max(merged_ranges[-1][1], end)
+        else:
+            merged_ranges.append([start, end])
+
+    return [tuple(byte_range) for byte_range in merged_ranges]
+
+
+def segment_byte_ranges(boxes, box_data, segments):
+    """Maps the segments to the merged byte ranges of the video needed to
+    decode them, besides the top level boxes not holding samples."""
+    segments = [(0, HEAD_SEC)] + list(segments)
+
+    sidx_ranges = []
+    for box_type, offset, box_size in boxes:
+        if box_type == b"sidx":
+            _, sidx_start, sidx_end = next(iter_boxes(box_data[offset]))
+            sidx_ranges.append(
+                sidx_byte_ranges(
+                    box_data[offset][sidx_start:sidx_end], offset + box_size, segments
+                )
+            )
+
+    if sidx_ranges:
+        return merge_byte_ranges(
+            byte_range for byte_ranges in sidx_ranges for byte_range in byte_ranges
+        )
+
+    moov_offset = next(
+        (offset for box_type, offset, _ in boxes if box_type == b"moov"), None
+    )
+    if moov_offset is None:
+        raise ValueError("No moov box")
+
+    moov = box_data[moov_offset]
+    _, moov_start, moov_end = next(iter_boxes(moov))
+    tracks = [
+        parse_track(moov, start, end)
+        for box_type, start, end in iter_boxes(moov, moov_start, moov_end)
+        if box_type == b"trak"
+    ]
+    if not any(track["sample_times"] for track in tracks):
+        raise ValueError("Fragmented MP4 without a sidx box")
+
+    return merge_byte_ranges(track_byte_ranges(tracks, segments))
+
+
+def fetch_segments(
+    s3,
+    s3_bucket_name,
+    s3_key,
+    video_filename,
+    segments,
+    video_size=None,
+    max_workers=8,
+):
+    """Fetches the bytes of an MP4 video on S3 covering the (start_sec, end_sec)
+    segments into a sparse local file, and returns the number of bytes fetched.
+
+    The whole video is downloaded when its index cannot be used.
+    """
+    if video_size is None:
+        video_size = s3.head_object(Bucket=s3_bucket_name, Key=s3_key)["ContentLength"]
+
+    try:
+        boxes, box_data = read_top_level_boxes(s3, s3_bucket_name, s3_key, video_size)
+        byte_ranges = segment_byte_ranges(boxes, box_data, segments)
+    except (ValueError, KeyError, IndexError, struct.error) as e:
+        print(f"Downloading the whole {s3_key}, its index cannot be used: {e}")
+        s3.download_file(s3_bucket_name, s3_key, video_filename)
+        return video_size
+
+    parts = [
+        (part_start, min(part_start + PART_BYTES, end))
+        for start, end in byte_ranges
+        for part_start in range(start, end, PART_BYTES)
+    ]
+
+    with open(video_filename, "wb") as out_file:
+        out_file.truncate(video_size)
+        file_descriptor = out_file.fileno()
+
+        for offset, data in box_data.items():
+            os.pwrite(file_descriptor, data, offset)
+
+        def fetch_part(part):
+            part_start, part_end = part
+            data = read_range(s3, s3_bucket_name, s3_key, part_start, part_end)
+            os.pwrite(file_descriptor, data, part_start)
+            return len(data)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            fetched_bytes = sum(executor.map(fetch_part, parts))
+
+    return fetched_bytes + sum(len(data) for data in box_data.values())
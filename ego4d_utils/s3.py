@@ -0,0 +1,267 @@
+"""S3 access to the Ego4D source videos shared by the preparation scripts."""
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+from ego4d_utils.ranged import fetch_segments
+
+
+def make_s3_client(
+    aws_access_key_id, aws_secret_access_key, region_name, max_pool_connections=10
+):
+    """Creates an S3 client whose connection pool is shared by all its threads."""
+    return boto3.client(
+        "s3",
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        region_name=region_name,
+        config=Config(max_pool_connections=max_pool_connections),
+    )
+
+
+def parse_s3_path(s3_path):
+    """Splits an s3://bucket/key path into its bucket name and key."""
+    s3_path_parts = s3_path.split("/")
+    return s3_path_parts[2], "/".join(s3_path_parts[3:])
+
+
+def fetch_video(
+    s3,
+    video_uid,
+    s3_bucket_name,
+    s3_key,
+    download_dir=".",
+    cache=None,
+    segments=None,
+    video_head=None,
+):
+    """Fetches a source video and returns its local filename, and whether it
+    comes from the cache and must be released to it rather than deleted.
+
+    When (start_sec, end_sec) segments are given, only the bytes covering them
+    are read, unless the whole video is already cached. Such partial videos are
+    never added to the cache.
+    """
+    if cache is not None:
+        if video_head is None:
+            video_head = s3.head_object(Bucket=s3_bucket_name, Key=s3_key)
+
+        if segments is None:
+            video_filename = cache.fetch(
+                s3, video_uid, s3_bucket_name, s3_key, etag=video_head["ETag"]
+            )
+            return video_filename, True
+
+        video_filename = cache.lookup(video_uid, video_head["ETag"])
+        if video_filename is not None:
+            return video_filename, True
+
+    video_filename = os.path.join(download_dir, f"{video_uid}.mp4")
+
+    try:
+        if segments is None:
+            s3.download_file(s3_bucket_name, s3_key, video_filename)
+        else:
+            fetch_segments(
+                s3,
+                s3_bucket_name,
+                s3_key,
+                video_filename,
+                segments,
+                video_size=(
+                    None if video_head is None else video_head["ContentLength"]
+                ),
+            )
+    except Exception:
+        # A partial video, sparse when fetching segments, is outside of any
+        # disk budget
+        if os.path.exists(video_filename):
+            os.remove(video_filename)
+        raise
+
+    return video_filename, False
+
+
+class S3VideoPrefetcher:
+    """Downloads the next source videos in background threads.
+
+    Iterating over the prefetcher yields (video_uid, video_filename) tuples in
+    the order of `videos`, a list of (video_uid, s3_bucket_name, s3_key)
+    tuples, while the following `num_prefetch` videos are being downloaded.
+    The filename is None when the download failed. Every yielded video must be
+    released once it has been trimmed, which deletes it and frees its share of
+    the disk budget.
+
+    Disk space is reserved in the order of `videos`, so the video consumed next
+    never waits for space taken by a later one. A video larger than the whole
+    budget is still downloaded once nothing else is on disk.
+
+    When a VideoCache is given, the videos are read through it and releasing
+    them only unpins them, so the disk usage is bounded by the cache budget
+    instead of `max_disk_gb`.
+
+    When `segments` maps the video_uids to lists of (start_sec, end_sec)
+    segments, only the bytes covering them are fetched, see fetch_video.
+    """
+
+    def __init__(
+        self,
+        s3,
+        videos,
+        download_dir=".",
+        num_prefetch=2,
+        max_disk_gb=None,
+        cache=None,
+        segments=None,
+    ):
+        self._s3 = s3
+        self._videos = videos
+        self._download_dir = download_dir
+        self._num_prefetch = max(num_prefetch, 1)
+        self._max_disk_bytes = (
+            None
+            if max_disk_gb is None or cache is not None
+            else int(max_disk_gb * 1024**3)
+        )
+        self._cache = cache
+        self._segments = segments
+
+        self._condition = threading.Condition()
+        self._reserved_bytes = 0
+        self._next_reservation = 0
+        self._video_sizes = {}
+        self._video_filenames = {}
+        self._cached_videos = set()
+        self._closed = False
+
+        self._executor = ThreadPoolExecutor(self._num_prefetch)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        videos = iter(enumerate(self._videos))
+        pending = deque()
+
+        def submit_next():
+            next_video = next(videos, None)
+            if next_video is not None:
+                index, video = next_video
+                pending.append(self._executor.submit(self._download, index, *video))
+
+        for _ in range(self._num_prefetch):
+            submit_next()
+
+        while pending:
+            future = pending.popleft()
+            submit_next()
+            yield future.result()
+
+    def _fits(self, video_size):
+        return (
+            self._max_disk_bytes is None
+            or self._reserved_bytes == 0
+            or self._reserved_bytes + video_size <= self._max_disk_bytes
+        )
+
+    def _reserve(self, index, s3_bucket_name, s3_key):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._closed or self._next_reservation == index
+            )
+
+        try:
+            if self._closed:
+                raise RuntimeError("The prefetcher has been closed")
+
+            video_head = self._s3.head_object(Bucket=s3_bucket_name, Key=s3_key)
+            video_size = video_head["ContentLength"]
+
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or self._fits(video_size))
+                if self._closed:
+                    raise RuntimeError("The prefetcher has been closed")
+                self._reserved_bytes += video_size
+        finally:
+            with self._condition:
+                self._next_reservation += 1
+                self._condition.notify_all()
+
+        return video_head
+
+    def _download(self, index, video_uid, s3_bucket_name, s3_key):
+        try:
+            video_head = self._reserve(index, s3_bucket_name, s3_key)
+        except Exception as e:
+            print(f"Failed to download {video_uid}: {e}")
+            return video_uid, None
+
+        with self._condition:
+            self._video_sizes[video_uid] = video_head["ContentLength"]
+            # Deleted on release should the download fail halfway
+            self._video_filenames[video_uid] = os.path.join(
+                self._download_dir, f"{video_uid}.mp4"
+            )
+
+        try:
+            video_filename, cached = fetch_video(
+                self._s3,
+                video_uid,
+                s3_bucket_name,
+                s3_key,
+                download_dir=self._download_dir,
+                cache=self._cache,
+                segments=(
+                    None if self._segments is None else self._segments[video_uid]
+                ),
+                video_head=video_head,
+            )
+        except Exception as e:
+            print(f"Failed to download {video_uid}: {e}")
+            self.release(video_uid)
+            return video_uid, None
+
+        with self._condition:
+            self._video_filenames[video_uid] = video_filename
+            if cached:
+                self._cached_videos.add(video_uid)
+
+        return video_uid, video_filename
+
+    def release(self, video_uid):
+        """Deletes a downloaded video, or unpins it from the cache, and frees its
+        share of the disk budget."""
+        with self._condition:
+            video_size = self._video_sizes.pop(video_uid, 0)
+            video_filename = self._video_filenames.pop(video_uid, None)
+            cached = video_uid in self._cached_videos
+            self._cached_videos.discard(video_uid)
+            self._reserved_bytes -= video_size
+            self._condition.notify_all()
+
+        if video_filename is None:
+            return
+
+        if cached:
+            self._cache.release(video_filename)
+        elif os.path.exists(video_filename):
+            os.remove(video_filename)
+
+    def close(self):
+        """Stops the pending downloads and deletes the videos not released yet."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+        for video_uid in list(self._video_filenames):
+            self.release(video_uid)
@@ -0,0 +1,425 @@
+"""Clip trimming shared by the Ego4D preparation scripts.
+
+Three trimming modes are supported:
+- reencode: decode the clip and re-encode it (frame accurate). All the clips of
+  a source video are cut in a single sweep decoding every frame at most once.
+- copy: stream copy the clip from the keyframe preceding its start, without
+  re-encoding anything.
+- keyframe: stream copy the clip from the first keyframe after its start and
+  re-encode only the leading partial GOP, so the cut is accurate while most of
+  the clip is copied as it is.
+"""
+
+import math
+import os
+import subprocess
+import tempfile
+
+import numpy as np
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+
+TRIM_MODES = ("reencode", "copy", "keyframe")
+
+# Keyframes closer than this to the start of a clip are used as they are
+KEYFRAME_TOLERANCE_SEC = 0.01
+
+# Bitstream filters putting the parameter sets in-band, so that a re-encoded
+# head and a stream copied tail can be concatenated
+ANNEXB_FILTERS = {"h264": "h264_mp4toannexb", "hevc": "hevc_mp4toannexb"}
+VIDEO_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+AUDIO_ENCODERS = {"aac": "aac", "mp3": "libmp3lame"}
+
+# Codecs of the re-encoded clips, the defaults of moviepy for MP4 files
+REENCODE_VIDEO_CODEC = "libx264"
+REENCODE_AUDIO_CODEC = "libmp3lame"
+
+
+def run_ffmpeg(*ffmpeg_args, capture_output=False):
+    """Runs the ffmpeg binary used by moviepy and returns its standard output."""
+    process = subprocess.run(
+        [get_setting("FFMPEG_BINARY"), "-v", "error", "-y", *ffmpeg_args],
+        check=True,
+        capture_output=capture_output,
+        text=True,
+    )
+    return process.stdout
+
+
+def probe_keyframes(video_filename, start_sec, end_sec):
+    """Returns the codecs of the first video and audio streams, and the times
+    of the video keyframes between start_sec and end_sec.
+
+    Packets are read without being decoded, so this only costs the I/O of the
+    GOPs covering the requested interval.
+    """
+    output = run_ffmpeg(
+        "-ss",
+        f"{start_sec:.3f}",
+        "-i",
+        video_filename,
+        "-to",
+        f"{end_sec:.3f}",
+        "-map",
+        "0:v:0",
+        "-map",
+        "0:a:0?",
+        "-c",
+        "copy",
+        "-copyts",
+        "-f",
+        "framecrc",
+        "-",
+        capture_output=True,
+    )
+
+    codecs = {}
+    time_base = None
+    keyframes = []
+
+    for line in output.splitlines():
+        if line.startswith("#codec_id"):
+            stream, codec = line[len("#codec_id") :].split(":")
+            codecs[int(stream)] = codec.strip()
+        elif line.startswith("#tb 0:"):
+            numerator, denominator = line[len("#tb 0:") :].split("/")
+            time_base = int(numerator) / int(denominator)
+        elif line and not line.startswith("#"):
+            fields = [field.strip() for field in line.split(",")]
+            flags = 1
+            if fields[-1].startswith("F="):
+                flags = int(fields[-1][2:], 16)
+            if fields[0] == "0" and flags & 1:
+                keyframes.append(int(fields[2]) * time_base)
+
+    keyframes = [
+        keyframe
+        for keyframe in keyframes
+        if start_sec - KEYFRAME_TOLERANCE_SEC <= keyframe < end_sec
+    ]
+
+    return codecs.get(0), codecs.get(1), keyframes
+
+
+def copy_clip(video_filename, start_sec, end_sec, output_filename):
+    """Stream copies a clip, starting from the keyframe preceding start_sec."""
+    run_ffmpeg(
+        "-ss",
+        f"{start_sec:.3f}",
+        "-i",
+        video_filename,
+        "-t",
+        f"{end_sec - start_sec:.3f}",
+        "-map",
+        "0:v:0",
+        "-map",
+        "0:a:0?",
+        "-c",
+        "copy",
+        "-avoid_negative_ts",
+        "make_zero",
+        output_filename,
+    )
+
+
+def encode_clip(
+    video_filename,
+    start_sec,
+    end_sec,
+    output_filename,
+    video_codec="libx264",
+    audio_codec="aac",
+):
+    """Re-encodes a clip with ffmpeg, seeking to start_sec accurately."""
+    run_ffmpeg(
+        "-ss",
+        f"{start_sec:.3f}",
+        "-i",
+        video_filename,
+        "-t",
+        f"{end_sec - start_sec:.3f}",
+        "-map",
+        "0:v:0",
+        "-map",
+        "0:a:0?",
+        "-c:v",
+        video_codec,
+        "-c:a",
+        audio_codec,
+        output_filename,
+    )
+
+
+def keyframe_seek_sec(keyframe):
+    """Returns the millisecond time at which a stream copy starts at a keyframe.
+
+    The keyframe time is rounded up, as rounding it down would seek to the
+    keyframe preceding it, less than a frame later for any frame rate below
+    1000 fps."""
+    return math.ceil(keyframe * 1000) / 1000
+
+
+def keyframe_clip(video_filename, start_sec, end_sec, output_filename):
+    """Re-encodes the leading partial GOP of a clip and stream copies the rest."""
+    video_codec, audio_codec, keyframes = probe_keyframes(
+        video_filename, start_sec, end_sec
+    )
+
+    if video_codec not in ANNEXB_FILTERS or (
+        audio_codec is not None and audio_codec not in AUDIO_ENCODERS
+    ):
+        # The two parts could not be concatenated losslessly
+        encode_clip(video_filename, start_sec, end_sec, output_filename)
+        return
+
+    if not keyframes:
+        # The whole clip falls inside a single partial GOP
+        encode_clip(
+            video_filename,
+            start_sec,
+            end_sec,
+            output_filename,
+            video_codec=VIDEO_ENCODERS[video_codec],
+            audio_codec=AUDIO_ENCODERS.get(audio_codec, "aac"),
+        )
+        return
+
+    first_keyframe = keyframes[0]
+
+    if first_keyframe - start_sec <= KEYFRAME_TOLERANCE_SEC:
+        copy_clip(
+            video_filename, keyframe_seek_sec(first_keyframe), end_sec, output_filename
+        )
+        return
+
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(output_filename) or "."
+    ) as parts_dir:
+        head_filename = os.path.join(parts_dir, "head.mp4")
+        tail_filename = os.path.join(parts_dir, "tail.mp4")
+        parts_list_filename = os.path.join(parts_dir, "parts.txt")
+
+        encode_clip(
+            video_filename,
+            start_sec,
+            first_keyframe,
+            head_filename,
+            video_codec=VIDEO_ENCODERS[video_codec],
+            audio_codec=AUDIO_ENCODERS.get(audio_codec, "aac"),
+        )
+        copy_clip(
+            video_filename, keyframe_seek_sec(first_keyframe), end_sec, tail_filename
+        )
+
+        with open(parts_list_filename, "w") as out_file:
+            out_file.write(f"file '{os.path.abspath(head_filename)}'\n")
+            out_file.write(f"file '{os.path.abspath(tail_filename)}'\n")
+
+        run_ffmpeg(
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            parts_list_filename,
+            "-map",
+            "0",
+            "-c",
+            "copy",
+            "-bsf:v",
+            ANNEXB_FILTERS[video_codec],
+            output_filename,
+        )
+
+
+def start_clip_encoder(
+    video_filename, start_sec, end_sec, output_filename, frame_size, fps
+):
+    """Starts an ffmpeg process encoding the RGB frames written to its standard
+    input, muxed with the audio of the [start_sec, end_sec] interval, and
+    returns it with the file collecting its errors."""
+    height, width = frame_size
+    # A file rather than a pipe, which could fill up while frames are written
+    error_file = tempfile.TemporaryFile()
+    encoder = subprocess.Popen(
+        [
+            get_setting("FFMPEG_BINARY"),
+            "-v",
+            "error",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            f"{fps}",
+            "-i",
+            "-",
+            "-ss",
+            f"{start_sec:.3f}",
+            "-t",
+            f"{end_sec - start_sec:.3f}",
+            "-i",
+            video_filename,
+            "-map",
+            "0:v:0",
+            "-map",
+            "1:a:0?",
+            "-c:v",
+            REENCODE_VIDEO_CODEC,
+            "-pix_fmt",
+            "yuv420p",
+            "-c:a",
+            REENCODE_AUDIO_CODEC,
+            output_filename,
+        ],
+        stdin=subprocess.PIPE,
+        stderr=error_file,
+    )
+
+    return encoder, error_file
+
+
+def finish_clip_encoder(encoder, error_file):
+    """Waits for a clip encoder to write its output, raising if it failed."""
+    with error_file:
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+        encoder.wait()
+
+        if encoder.returncode != 0:
+            error_file.seek(0)
+            raise subprocess.CalledProcessError(
+                encoder.returncode, encoder.args, stderr=error_file.read().decode()
+            )
+
+
+def reencode_clips(video_filename, clips):
+    """Re-encodes (start_sec, end_sec, output_filename) clips of a video,
+    decoding every frame of the video at most once.
+
+    The clips are swept in the order of their start: each decoded frame is
+    written to the encoders of all the clips covering it, so overlapping clips
+    share their decoding and the frames between the clips are skipped. Returns
+    the exception raised for each clip, or None when it was trimmed.
+    """
+    errors = [None] * len(clips)
+    if not clips:
+        return errors
+
+    reader = FFMPEG_VideoReader(video_filename)
+    encoders = {}
+
+    try:
+        fps = reader.fps
+
+        # Frames [first, last) of every clip, as moviepy would pick them
+        num_video_frames = int(reader.duration * fps)
+        frame_ranges = []
+        for start_sec, end_sec, _ in clips:
+            first_frame = int(fps * start_sec + 0.00001)
+            num_frames = len(np.arange(0, end_sec - start_sec, 1.0 / fps))
+            frame_ranges.append(
+                (first_frame, min(first_frame + num_frames, num_video_frames))
+            )
+
+        clip_order = sorted(range(len(clips)), key=lambda clip: frame_ranges[clip])
+        next_clip = 0
+        frame_index = 0
+
+        while next_clip < len(clip_order) or encoders:
+            if not encoders:
+                # Skip to the next clip rather than decoding the frames between
+                frame_index = max(frame_index, frame_ranges[clip_order[next_clip]][0])
+
+            frame = reader.get_frame(frame_index / fps)
+
+            while (
+                next_clip < len(clip_order)
+                and frame_ranges[clip_order[next_clip]][0] <= frame_index
+            ):
+                clip = clip_order[next_clip]
+                next_clip += 1
+                if frame_ranges[clip][0] >= frame_ranges[clip][1]:
+                    errors[clip] = ValueError(
+                        f"Empty clip {clips[clip][0]}-{clips[clip][1]}"
+                    )
+                    continue
+                encoders[clip] = start_clip_encoder(
+                    video_filename, *clips[clip], frame.shape[:2], fps
+                )
+
+            frame_data = frame.tobytes()
+            frame_index += 1
+
+            for clip, (encoder, error_file) in list(encoders.items()):
+                try:
+                    encoder.stdin.write(frame_data)
+                except BrokenPipeError:
+                    # The encoder failed, finishing it reports why
+                    frame_ranges[clip] = (frame_ranges[clip][0], frame_index)
+
+                if frame_ranges[clip][1] <= frame_index:
+                    del encoders[clip]
+                    try:
+                        finish_clip_encoder(encoder, error_file)
+                    except Exception as e:
+                        errors[clip] = e
+    except Exception as e:
+        for clip in clip_order[next_clip:]:
+            errors[clip] = e
+        for clip, (encoder, error_file) in encoders.items():
+            encoder.kill()
+            encoder.wait()
+            error_file.close()
+            errors[clip] = e
+    finally:
+        reader.close()
+
+    return errors
+
+
+def trim_clips(video_filename, clips, trim_mode="reencode"):
+    """Trims several (start_sec, end_sec, output_filename) clips of a video and
+    returns the exception raised for each of them, or None when it was trimmed.
+    """
+    if trim_mode == "reencode":
+        return reencode_clips(video_filename, clips)
+
+    errors = []
+    for start_sec, end_sec, output_filename in clips:
+        try:
+            trim_clip(
+                video_filename, start_sec, end_sec, output_filename, trim_mode=trim_mode
+            )
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+
+    return errors
+
+
+def trim_clip(
+    video_filename,
+    start_sec,
+    end_sec,
+    output_filename,
+    trim_mode="reencode",
+):
+    """Trims the [start_sec, end_sec] interval of a video into output_filename."""
+    if trim_mode == "copy":
+        copy_clip(video_filename, start_sec, end_sec, output_filename)
+    elif trim_mode == "keyframe":
+        keyframe_clip(video_filename, start_sec, end_sec, output_filename)
+    elif trim_mode == "reencode":
+        (error,) = reencode_clips(
+            video_filename, [(start_sec, end_sec, output_filename)]
+        )
+        if error is not None:
+            raise error
+    else:
+        raise ValueError(f"Unknown trim mode: {trim_mode}")
@@ -1,11 +1,185 @@
 import argparse
 import json
+import multiprocessing
 import os
+import sys
 
-import boto3
-from moviepy.editor import VideoFileClip
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ego4d_utils.cache import VideoCache  # noqa: E402
+from ego4d_utils.s3 import (  # noqa: E402
+    S3VideoPrefetcher,
+    fetch_video,
+    make_s3_client,
+)
+from ego4d_utils.trimming import TRIM_MODES, trim_clips  # noqa: E402
+
+s3 = None
+cache = None
+trim_mode = None
+ranged_reads = False
+
+
+def init_worker(
+    aws_access_key_id,
+    aws_secret_access_key,
+    region_name,
+    worker_trim_mode,
+    cache_dir=None,
+    cache_max_gb=None,
+    worker_ranged_reads=False,
+):
+    """Creates the S3 client and video cache used by the current trimming process."""
+    global s3, cache, trim_mode, ranged_reads
+
+    trim_mode = worker_trim_mode
+    ranged_reads = worker_ranged_reads
+
+    s3 = make_s3_client(aws_access_key_id, aws_secret_access_key, region_name)
+
+    if cache_dir is not None:
+        cache = VideoCache(cache_dir, max_gb=cache_max_gb)
+
+
+def collect_video_jobs(
+    ego4d_nlq, video_uid2video, trimmed_videos_path, min_duration, max_duration
+):
+    """Groups the answered language queries by video_uid, keeping the NLQ order."""
+    video_jobs = {}
+
+    for video in ego4d_nlq["videos"]:
+        for clip in video["clips"]:
+            for annotation in clip["annotations"]:
+                for language_query_index, language_query in enumerate(
+                    annotation["language_queries"]
+                ):
+                    if "answer" not in language_query:
+                        continue
+
+                    video_start_sec = max(
+                        language_query["video_start_sec"],
+                        0,
+                    )
+                    video_end_sec = min(
+                        language_query["video_end_sec"],
+                        video_uid2video[video["video_uid"]]["duration_sec"],
+                    )
+
+                    if not (
+                        min_duration <= video_end_sec - video_start_sec <= max_duration
+                    ):
+                        continue
+
+                    if video["video_uid"] not in video_jobs:
+                        s3_video_path_parts = video_uid2video[video["video_uid"]][
+                            "s3_path"
+                        ].split("/")
+                        video_jobs[video["video_uid"]] = {
+                            "video_uid": video["video_uid"],
+                            "s3_bucket_name": s3_video_path_parts[2],
+                            "s3_key": "/".join(s3_video_path_parts[3:]),
+                            "segments": [],
+                        }
+
+                    video_jobs[video["video_uid"]]["segments"].append(
+                        {
+                            "video_start_sec": video_start_sec,
+                            "video_end_sec": video_end_sec,
+                            "trimmed_video_filename": os.path.join(
+                                trimmed_videos_path,
+                                video["video_uid"],
+                                clip["clip_uid"],
+                                annotation["annotation_uid"],
+                                f"{language_query_index}.mp4",
+                            ),
+                            "query": language_query["query"],
+                            "answer": language_query["answer"].replace(
+                                "Answer (Optional):", ""
+                            ),
+                        }
+                    )
+
+    return list(video_jobs.values())
+
+
+def trim_video_segments(video_job, video_filename):
+    """Trims all the segments of a job from its downloaded source video."""
+    for segment in video_job["segments"]:
+        os.makedirs(os.path.dirname(segment["trimmed_video_filename"]), exist_ok=True)
+
+    errors = trim_clips(
+        video_filename,
+        [
+            (
+                segment["video_start_sec"],
+                segment["video_end_sec"],
+                segment["trimmed_video_filename"],
+            )
+            for segment in video_job["segments"]
+        ],
+        trim_mode=trim_mode,
+    )
+
+    for segment, error in zip(video_job["segments"], errors):
+        if error is not None:
+            raise error
+        print(f"Trimmed video saved to: {segment['trimmed_video_filename']}")
+
+    return video_job["segments"]
+
+
+def video_job_segments(video_job):
+    """Returns the (start_sec, end_sec) segments to fetch with ranged reads."""
+    if not ranged_reads:
+        return None
+
+    return [
+        (segment["video_start_sec"], segment["video_end_sec"])
+        for segment in video_job["segments"]
+    ]
+
+
+def trim_video_job(video_job):
+    """Downloads the source video of a job and trims all of its segments.
+
+    A video which cannot be downloaded is skipped, as by the prefetcher."""
+    try:
+        video_filename, cached = fetch_video(
+            s3,
+            video_job["video_uid"],
+            video_job["s3_bucket_name"],
+            video_job["s3_key"],
+            cache=cache,
+            segments=video_job_segments(video_job),
+        )
+    except Exception as e:
+        print(f"Failed to download {video_job['video_uid']}: {e}")
+        return []
+
+    try:
+        return trim_video_segments(video_job, video_filename)
+    finally:
+        if cached:
+            cache.release(video_filename)
+        else:
+            os.remove(video_filename)
+
+
+def trim_prefetched_video_jobs(video_jobs, prefetcher):
+    """Trims the jobs while the prefetcher downloads the next source videos."""
+    for video_job, (video_uid, video_filename) in zip(video_jobs, prefetcher):
+        if video_filename is None:
+            yield []
+            continue
+
+        try:
+            yield trim_video_segments(video_job, video_filename)
+        finally:
+            prefetcher.release(video_uid)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -56,6 +230,53 @@ if __name__ == "__main__":
         required=True,
         help="Ego4D AWS region name, obtained from Ego4D",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of processes trimming videos in parallel",
+    )
+    parser.add_argument(
+        "--num_prefetch",
+        type=int,
+        default=2,
+        help="Number of source videos downloaded ahead of the one being trimmed, "
+        "when trimming in a single process",
+    )
+    parser.add_argument(
+        "--prefetch_max_gb",
+        type=float,
+        default=None,
+        help="Disk budget in GB of the prefetched source videos",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory of a persistent source video cache, which can be shared "
+        "with the other Ego4D preparation scripts",
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        type=float,
+        default=None,
+        help="Disk budget in GB of the source video cache",
+    )
+    parser.add_argument(
+        "--trim_mode",
+        type=str,
+        choices=TRIM_MODES,
+        default="reencode",
+        help="reencode: frame accurate re-encoding, copy: stream copy from the "
+        "preceding keyframe, keyframe: stream copy with only the leading partial "
+        "GOP re-encoded",
+    )
+    parser.add_argument(
+        "--ranged_reads",
+        action="store_true",
+        help="Only fetch the bytes of the source videos covering the segments to "
+        "trim, instead of the whole videos",
+    )
     args = parser.parse_args()
 
     with open(args.ego4d_videos_path) as in_file:
@@ -67,101 +288,87 @@ if __name__ == "__main__":
     with open(args.ego4d_nlq_path) as in_file:
         ego4d_nlq = json.load(in_file)
 
-    dataset = []
+    video_jobs = collect_video_jobs(
+        ego4d_nlq,
+        video_uid2video,
+        args.ego4d_trimmed_videos_path,
+        args.min_duration,
+        args.max_duration,
+    )
 
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=args.ego4d_aws_access_key_id,
-        aws_secret_access_key=args.ego4d_aws_secret_access_key,
-        region_name=args.ego4d_aws_region_name,
+    worker_args = (
+        args.ego4d_aws_access_key_id,
+        args.ego4d_aws_secret_access_key,
+        args.ego4d_aws_region_name,
+        args.trim_mode,
+        args.cache_dir,
+        args.cache_max_gb,
+        args.ranged_reads,
     )
 
-    last_downloaded_video_filename = None
-    last_downloaded_video = None
+    pool = None
+    prefetcher = None
 
-    for video in tqdm(ego4d_nlq["videos"], total=len(ego4d_nlq["videos"])):
-        for clip in video["clips"]:
-            for annotation in clip["annotations"]:
-                for language_query_index, language_query in enumerate(
-                    annotation["language_queries"]
-                ):
-                    if "answer" in language_query:
-                        s3_video_path_parts = video_uid2video[video["video_uid"]][
-                            "s3_path"
-                        ].split("/")
-                        s3_bucket_name = s3_video_path_parts[2]
-                        s3_key = "/".join(s3_video_path_parts[3:])
-                        s3_filename = s3_video_path_parts[-3]
-                        video_filename = video["video_uid"]
-
-                        if video_filename != last_downloaded_video_filename:
-                            if last_downloaded_video_filename:
-                                os.remove(last_downloaded_video_filename)
-                                last_downloaded_video.close()
-                                del last_downloaded_video
-                            s3.download_file(s3_bucket_name, s3_key, video_filename)
-                            last_downloaded_video_filename = video_filename
-                            last_downloaded_video = VideoFileClip(
-                                last_downloaded_video_filename
-                            )
-
-                        video_start_sec = max(
-                            language_query["video_start_sec"],
-                            0,
-                        )
-                        video_end_sec = min(
-                            language_query["video_end_sec"],
-                            video_uid2video[video["video_uid"]]["duration_sec"],
-                        )
-
-                        if (
-                            args.min_duration
-                            <= video_end_sec - video_start_sec
-                            <= args.max_duration
-                        ):
-                            trimmed_video_path = os.path.join(
-                                args.ego4d_trimmed_videos_path,
-                                video["video_uid"],
-                                clip["clip_uid"],
-                                annotation["annotation_uid"],
-                            )
-
-                            os.makedirs(trimmed_video_path, exist_ok=True)
-
-                            trimmed_video_filename = os.path.join(
-                                trimmed_video_path, f"{language_query_index}.mp4"
-                            )
-
-                            video_clip = last_downloaded_video.subclip(
-                                video_start_sec, video_end_sec
-                            )
-                            video_clip.write_videofile(
-                                trimmed_video_filename, remove_temp=True, logger=None
-                            )
-
-                            print(f"Trimmed video saved to: {trimmed_video_filename}")
-
-                            dataset.append(
-                                {
-                                    "id": len(dataset),
-                                    "video": trimmed_video_filename,
-                                    "conversations": [
-                                        {
-                                            "from": "human",
-                                            "value": f"<video>\n{language_query['query']}",
-                                        },
-                                        {
-                                            "from": "gpt",
-                                            "value": language_query["answer"].replace(
-                                                "Answer (Optional):", ""
-                                            ),
-                                        },
-                                    ],
-                                }
-                            )
-
-    if os.path.exists(last_downloaded_video_filename):
-        os.remove(last_downloaded_video_filename)
+    if args.num_workers > 1:
+        # Each worker owns the download and the trims of a whole video, while
+        # imap hands the jobs back in submission order to keep the ids stable
+        pool = multiprocessing.Pool(
+            args.num_workers, initializer=init_worker, initargs=worker_args
+        )
+        trimmed_video_jobs = pool.imap(trim_video_job, video_jobs)
+    else:
+        init_worker(*worker_args)
+        prefetcher = S3VideoPrefetcher(
+            s3,
+            [
+                (
+                    video_job["video_uid"],
+                    video_job["s3_bucket_name"],
+                    video_job["s3_key"],
+                )
+                for video_job in video_jobs
+            ],
+            num_prefetch=args.num_prefetch,
+            max_disk_gb=args.prefetch_max_gb,
+            cache=cache,
+            segments=(
+                {
+                    video_job["video_uid"]: video_job_segments(video_job)
+                    for video_job in video_jobs
+                }
+                if ranged_reads
+                else None
+            ),
+        )
+        trimmed_video_jobs = trim_prefetched_video_jobs(video_jobs, prefetcher)
+
+    dataset = []
+
+    for trimmed_segments in tqdm(trimmed_video_jobs, total=len(video_jobs)):
+        for segment in trimmed_segments:
+            dataset.append(
+                {
+                    "id": len(dataset),
+                    "video": segment["trimmed_video_filename"],
+                    "conversations": [
+                        {
+                            "from": "human",
+                            "value": f"<video>\n{segment['query']}",
+                        },
+                        {
+                            "from": "gpt",
+                            "value": segment["answer"],
+                        },
+                    ],
+                }
+            )
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if prefetcher is not None:
+        prefetcher.close()
 
     with open(args.ego4d_vqa_path, "w") as out_file:
         json.dump(dataset, out_file)
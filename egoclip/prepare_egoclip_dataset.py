@@ -1,17 +1,149 @@
 import argparse
+import hashlib
+import io
 import json
+import multiprocessing
 import os
-import random
+import sys
 
-import boto3
+import numpy as np
 import pandas as pd
-from moviepy.editor import VideoFileClip
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ego4d_utils.cache import VideoCache  # noqa: E402
+from ego4d_utils.s3 import (  # noqa: E402
+    S3VideoPrefetcher,
+    fetch_video,
+    make_s3_client,
+    parse_s3_path,
+)
+from ego4d_utils.trimming import TRIM_MODES, trim_clips  # noqa: E402
+
+s3 = None
+cache = None
+trim_mode = None
+ranged_reads = False
+
+
+def init_worker(
+    aws_access_key_id,
+    aws_secret_access_key,
+    region_name,
+    worker_trim_mode,
+    cache_dir=None,
+    cache_max_gb=None,
+    worker_ranged_reads=False,
+):
+    """Creates the S3 client and video cache used by the current trimming process."""
+    global s3, cache, trim_mode, ranged_reads
+
+    trim_mode = worker_trim_mode
+    ranged_reads = worker_ranged_reads
+
+    s3 = make_s3_client(aws_access_key_id, aws_secret_access_key, region_name)
+
+    if cache_dir is not None:
+        cache = VideoCache(cache_dir, max_gb=cache_max_gb)
+
+
+# Columns of the EgoClip metadata used to prepare the dataset
+EGOCLIP_DTYPES = {
+    "video_uid": str,
+    "narration_ind": "int64",
+    "clip_start": "float64",
+    "clip_end": "float64",
+    "clip_text": str,
+}
+
+
+def file_fingerprint(filename):
+    """Identifies a version of a file by its path, size and modification time,
+    without reading it."""
+    stat = os.stat(filename)
+    return hashlib.sha256(
+        json.dumps([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]).encode()
+    ).hexdigest()
+
+
+def read_egoclip_metadata(egoclip_metadata):
+    """Reads the columns of EGOCLIP_DTYPES from the EgoClip metadata with the C
+    parser. The lines with more fields than the header, which it would reject,
+    are first cut to the fields of the header, found in a single pass over the
+    bytes of the file."""
+    with open(egoclip_metadata, "rb") as in_file:
+        data = in_file.read()
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.append(np.flatnonzero(buffer == ord("\n")), len(data))
+    tabs = np.flatnonzero(buffer == ord("\t"))
+    tab_lines = np.searchsorted(line_ends, tabs)
+    tabs_per_line = np.bincount(tab_lines, minlength=len(line_ends))
+
+    num_fields = tabs_per_line[0] + 1
+    bad_lines = np.flatnonzero(tabs_per_line >= num_fields)
+    if len(bad_lines) > 0:
+        # Each bad line is cut at the tab ending its last expected field
+        cuts = tabs[np.searchsorted(tab_lines, bad_lines) + num_fields - 1]
+        pieces = []
+        position = 0
+        for cut, line_end in zip(cuts, line_ends[bad_lines]):
+            pieces.append(data[position:cut])
+            position = line_end
+        pieces.append(data[position:])
+        data = b"".join(pieces)
+
+    return pd.read_csv(
+        io.BytesIO(data),
+        sep="\t",
+        usecols=list(EGOCLIP_DTYPES),
+        dtype=EGOCLIP_DTYPES,
+        engine="c",
+    )
+
+
+def load_egoclip_metadata(egoclip_metadata, min_duration, max_duration, cache_dir=None):
+    """Returns the EgoClip clips lasting between min_duration and max_duration.
+
+    They are cached as Parquet in cache_dir, keyed by the path, size and
+    modification time of the metadata file and the durations, so later runs
+    skip reading the CSV."""
+    cache_filename = None
+    if cache_dir is not None:
+        cache_filename = os.path.join(
+            cache_dir,
+            f"egoclip-{file_fingerprint(egoclip_metadata)[:16]}"
+            f"-{min_duration}-{max_duration}.parquet",
+        )
+        if os.path.exists(cache_filename):
+            return pd.read_parquet(cache_filename)
+
+    df = read_egoclip_metadata(egoclip_metadata)
+    filtered_df = df[
+        (df["clip_end"] - df["clip_start"] >= min_duration)
+        & (df["clip_end"] - df["clip_start"] <= max_duration)
+    ]
 
-def prepare_egoclip(egoclip_metadata, num_clips=50000, min_duration=2, max_duration=60):
-    df = pd.read_csv(
-        egoclip_metadata, sep="\t", on_bad_lines=lambda x: x[:-1], engine="python"
+    if cache_filename is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written aside and renamed, so a partial cache is never read
+        filtered_df.to_parquet(f"{cache_filename}.part")
+        os.replace(f"{cache_filename}.part", cache_filename)
+
+    return filtered_df
+
+
+def prepare_egoclip(
+    egoclip_metadata,
+    num_clips=50000,
+    min_duration=2,
+    max_duration=60,
+    cache_dir=None,
+    seed=42,
+):
+    filtered_df = load_egoclip_metadata(
+        egoclip_metadata, min_duration, max_duration, cache_dir=cache_dir
     )
 
     prompts = [
@@ -27,18 +159,12 @@ def prepare_egoclip(egoclip_metadata, num_clips=50000, min_duration=2, max_durat
         "What is the main focus of the video?",
     ]
 
-    def prompt_selection(row):
-        prompt = random.choice(prompts)
-        return prompt
-
-    df = df.drop("Unnamed: 10", axis=1)
-    filtered_df = df[
-        (df["clip_end"] - df["clip_start"] >= min_duration)
-        & (df["clip_end"] - df["clip_start"] <= max_duration)
-    ]
     sub_df = filtered_df.sample(n=num_clips, random_state=42)
 
-    sub_df["instruction"] = sub_df.apply(prompt_selection, axis=1)
+    rng = np.random.default_rng(seed)
+    sub_df["instruction"] = np.array(prompts, dtype=object)[
+        rng.integers(len(prompts), size=len(sub_df))
+    ]
 
     """
     There are four flags that annotators use in the sentence boxes:
@@ -53,33 +179,141 @@ def prepare_egoclip(egoclip_metadata, num_clips=50000, min_duration=2, max_durat
     Only one sentence for the entire video clip will have #summary.
     """
 
-    def transform_clip_text(row):
-        clip_text = row["clip_text"]
-
+    def transform_clip_texts(clip_texts):
         # This tag was used to denote that the annotator was unsure about a specific object/statement
-        clip_text = clip_text.replace("#UNSURE", "something")
-
-        if clip_text.startswith("Summary"):
-            # Simply remove the summary tag if it exists
-            clip_text = clip_text.replace("Summary", "")
-        elif clip_text.startswith("#C"):
-            clip_text = clip_text.replace("#C", "")
-        elif clip_text.startswith("#O"):
-            clip_text = clip_text.replace("#O", "")
-
-        clip_text = clip_text.replace("C", "the camera wearer", 1).replace(
-            "O", "another person", 1
-        )
+        clip_texts = clip_texts.str.replace("#UNSURE", "something", regex=False)
+
+        # Simply remove the summary tag if it exists, or else the first tag
+        summary = clip_texts.str.startswith("Summary")
+        camera_wearer = ~summary & clip_texts.str.startswith("#C")
+        other_person = ~summary & ~camera_wearer & clip_texts.str.startswith("#O")
+        for rows, tag in [
+            (summary, "Summary"),
+            (camera_wearer, "#C"),
+            (other_person, "#O"),
+        ]:
+            clip_texts[rows] = clip_texts[rows].str.replace(tag, "", regex=False)
 
-        clip_text = clip_text.strip()
+        clip_texts = clip_texts.str.replace(
+            "C", "the camera wearer", n=1, regex=False
+        ).str.replace("O", "another person", n=1, regex=False)
 
-        return (clip_text + ".").capitalize()
+        return (clip_texts.str.strip() + ".").str.capitalize()
 
-    sub_df["clip_text_refined"] = sub_df.apply(transform_clip_text, axis=1)
+    sub_df["clip_text_refined"] = transform_clip_texts(sub_df["clip_text"].copy())
 
     return sub_df
 
 
+def collect_video_jobs(egoclip_metadata, video_uid2video, trimmed_videos_path):
+    """Partitions the clips by video_uid, in the order of the sorted metadata."""
+    video_jobs = []
+
+    for video_uid, video_rows in egoclip_metadata.groupby("video_uid", sort=False):
+        video_duration = video_uid2video[video_uid]["duration_sec"]
+        s3_bucket_name, s3_key = parse_s3_path(video_uid2video[video_uid]["s3_path"])
+
+        video_jobs.append(
+            {
+                "video_uid": video_uid,
+                "s3_bucket_name": s3_bucket_name,
+                "s3_key": s3_key,
+                "clips": [
+                    {
+                        "clip_start": clip_start,
+                        "clip_end": min(clip_end, video_duration),
+                        "trimmed_video_filename": os.path.join(
+                            trimmed_videos_path, video_uid, f"{narration_ind}.mp4"
+                        ),
+                        "instruction": instruction,
+                        "clip_text_refined": clip_text_refined,
+                    }
+                    for narration_ind, clip_start, clip_end, instruction, clip_text_refined in zip(
+                        video_rows["narration_ind"],
+                        video_rows["clip_start"],
+                        video_rows["clip_end"],
+                        video_rows["instruction"],
+                        video_rows["clip_text_refined"],
+                    )
+                ],
+            }
+        )
+
+    return video_jobs
+
+
+def video_job_segments(video_job):
+    """Returns the (start_sec, end_sec) segments to fetch with ranged reads."""
+    if not ranged_reads:
+        return None
+
+    return [(clip["clip_start"], clip["clip_end"]) for clip in video_job["clips"]]
+
+
+def trim_video_clips(video_job, video_filename):
+    """Trims all the clips of a job from its downloaded source video, and
+    returns the ones trimmed successfully."""
+    for clip in video_job["clips"]:
+        os.makedirs(os.path.dirname(clip["trimmed_video_filename"]), exist_ok=True)
+
+    # All the clips of the video are trimmed together, so that overlapping
+    # clips are decoded only once
+    errors = trim_clips(
+        video_filename,
+        [
+            (clip["clip_start"], clip["clip_end"], clip["trimmed_video_filename"])
+            for clip in video_job["clips"]
+        ],
+        trim_mode=trim_mode,
+    )
+
+    trimmed_clips = []
+    for clip, error in zip(video_job["clips"], errors):
+        if error is not None:
+            print(f"Skipping {clip['trimmed_video_filename']}")
+            continue
+        trimmed_clips.append(clip)
+
+    return trimmed_clips
+
+
+def trim_video_job(video_job):
+    """Downloads the source video of a job and trims all of its clips."""
+    try:
+        video_filename, cached = fetch_video(
+            s3,
+            video_job["video_uid"],
+            video_job["s3_bucket_name"],
+            video_job["s3_key"],
+            cache=cache,
+            segments=video_job_segments(video_job),
+        )
+    except Exception as e:
+        print(f"Failed to download {video_job['video_uid']}: {e}")
+        return []
+
+    try:
+        return trim_video_clips(video_job, video_filename)
+    finally:
+        if cached:
+            cache.release(video_filename)
+        else:
+            os.remove(video_filename)
+
+
+def trim_prefetched_video_jobs(video_jobs, prefetcher):
+    """Trims the jobs while the prefetcher downloads the next source videos."""
+    for video_job, (video_uid, video_filename) in zip(video_jobs, prefetcher):
+        if video_filename is None:
+            yield []
+            continue
+
+        try:
+            yield trim_video_clips(video_job, video_filename)
+        finally:
+            prefetcher.release(video_uid)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -92,6 +326,24 @@ if __name__ == "__main__":
         type=str,
         default="../data/egoclip.csv",
     )
+    parser.add_argument(
+        "--egoclip_cache_dir",
+        type=str,
+        default="../data/egoclip_cache",
+        help="Directory of the parsed EgoClip metadata cache, keyed by the path, "
+        "size and modification time of the metadata file",
+    )
+    parser.add_argument(
+        "--no_egoclip_cache",
+        action="store_true",
+        help="Parse the EgoClip metadata without using its cache",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Seed of the instruction prompts given to the clips",
+    )
     parser.add_argument(
         "--ego4d_trimmed_videos_path",
         type=str,
@@ -120,6 +372,53 @@ if __name__ == "__main__":
         required=True,
         help="Ego4D AWS region name, obtained from Ego4D",
     )
+    parser.add_argument(
+        "--trim_mode",
+        type=str,
+        choices=TRIM_MODES,
+        default="reencode",
+        help="reencode: frame accurate re-encoding, copy: stream copy from the "
+        "preceding keyframe, keyframe: stream copy with only the leading partial "
+        "GOP re-encoded",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of processes trimming videos in parallel",
+    )
+    parser.add_argument(
+        "--num_prefetch",
+        type=int,
+        default=2,
+        help="Number of source videos downloaded ahead of the one being trimmed, "
+        "when trimming in a single process",
+    )
+    parser.add_argument(
+        "--prefetch_max_gb",
+        type=float,
+        default=None,
+        help="Disk budget in GB of the prefetched source videos",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory of a persistent source video cache, which can be shared "
+        "with the other Ego4D preparation scripts",
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        type=float,
+        default=None,
+        help="Disk budget in GB of the source video cache",
+    )
+    parser.add_argument(
+        "--ranged_reads",
+        action="store_true",
+        help="Only fetch the bytes of the source videos covering the clips to "
+        "trim, instead of the whole videos",
+    )
     args = parser.parse_args()
 
     with open(args.ego4d_videos_path) as in_file:
@@ -128,78 +427,92 @@ if __name__ == "__main__":
             video["video_uid"]: video for video in ego4d_videos["videos"]
         }
 
-    egoclip_metadata = prepare_egoclip(args.egoclip_metadata)
+    egoclip_metadata = prepare_egoclip(
+        args.egoclip_metadata,
+        cache_dir=None if args.no_egoclip_cache else args.egoclip_cache_dir,
+        seed=args.seed,
+    )
 
     egoclip_metadata = egoclip_metadata.sort_values("video_uid")
 
-    dataset = []
-
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=args.ego4d_aws_access_key_id,
-        aws_secret_access_key=args.ego4d_aws_secret_access_key,
-        region_name=args.ego4d_aws_region_name,
-    )
-
-    last_downloaded_video_filename = None
-    last_downloaded_video = None
-
-    for index, row in tqdm(egoclip_metadata.iterrows(), total=len(egoclip_metadata)):
-        video_uid = row["video_uid"]
-        s3_video_path_parts = video_uid2video[video_uid]["s3_path"].split("/")
-        s3_bucket_name = s3_video_path_parts[2]
-        s3_key = "/".join(s3_video_path_parts[3:])
-        s3_filename = s3_video_path_parts[-3]
-        video_filename = video_uid + ".mp4"
-
-        if video_filename != last_downloaded_video_filename:
-            if last_downloaded_video_filename:
-                os.remove(last_downloaded_video_filename)
-                last_downloaded_video.close()
-                del last_downloaded_video
-            s3.download_file(s3_bucket_name, s3_key, video_filename)
-            last_downloaded_video_filename = video_filename
-            last_downloaded_video = VideoFileClip(last_downloaded_video_filename)
-
-        video_start_sec = row["clip_start"]
-        video_end_sec = min(row["clip_end"], last_downloaded_video.duration)
-        trimmed_video_path = os.path.join(args.ego4d_trimmed_videos_path, video_uid)
-
-        os.makedirs(trimmed_video_path, exist_ok=True)
-
-        trimmed_video_filename = os.path.join(
-            trimmed_video_path, f"{row['narration_ind']}.mp4"
-        )
+    video_jobs = collect_video_jobs(
+        egoclip_metadata, video_uid2video, args.ego4d_trimmed_videos_path
+    )
 
-        try:
-            video_clip = last_downloaded_video.subclip(video_start_sec, video_end_sec)
-            video_clip.write_videofile(
-                trimmed_video_filename, remove_temp=True, logger=None
-            )
+    worker_args = (
+        args.ego4d_aws_access_key_id,
+        args.ego4d_aws_secret_access_key,
+        args.ego4d_aws_region_name,
+        args.trim_mode,
+        args.cache_dir,
+        args.cache_max_gb,
+        args.ranged_reads,
+    )
 
-            print(f"Trimmed video saved to: {trimmed_video_filename}")
+    pool = None
+    prefetcher = None
 
-            dataset.append(
+    if args.num_workers > 1:
+        # Each worker owns the download, the decoder and the trims of a whole
+        # video, while imap hands the jobs back in submission order to keep
+        # the ids stable
+        pool = multiprocessing.Pool(
+            args.num_workers, initializer=init_worker, initargs=worker_args
+        )
+        trimmed_video_jobs = pool.imap(trim_video_job, video_jobs)
+    else:
+        init_worker(*worker_args)
+        prefetcher = S3VideoPrefetcher(
+            s3,
+            [
+                (
+                    video_job["video_uid"],
+                    video_job["s3_bucket_name"],
+                    video_job["s3_key"],
+                )
+                for video_job in video_jobs
+            ],
+            num_prefetch=args.num_prefetch,
+            max_disk_gb=args.prefetch_max_gb,
+            cache=cache,
+            segments=(
                 {
-                    "id": len(dataset),
-                    "video": trimmed_video_filename,
-                    "conversations": [
-                        {
-                            "from": "human",
-                            "value": f"<video>\n{row['instruction']}",
-                        },
-                        {"from": "gpt", "value": row["clip_text_refined"]},
-                    ],
+                    video_job["video_uid"]: video_job_segments(video_job)
+                    for video_job in video_jobs
                 }
-            )
-        except (OSError, Exception):
-            print(f"Skipping {trimmed_video_filename}")
-            continue
+                if ranged_reads
+                else None
+            ),
+        )
+        trimmed_video_jobs = trim_prefetched_video_jobs(video_jobs, prefetcher)
+
+    dataset = []
 
-    if last_downloaded_video_filename is not None and os.path.exists(
-        last_downloaded_video_filename
-    ):
-        os.remove(last_downloaded_video_filename)
+    with tqdm(total=len(egoclip_metadata)) as progress_bar:
+        for video_job, trimmed_clips in zip(video_jobs, trimmed_video_jobs):
+            progress_bar.update(len(video_job["clips"]))
+
+            for clip in trimmed_clips:
+                dataset.append(
+                    {
+                        "id": len(dataset),
+                        "video": clip["trimmed_video_filename"],
+                        "conversations": [
+                            {
+                                "from": "human",
+                                "value": f"<video>\n{clip['instruction']}",
+                            },
+                            {"from": "gpt", "value": clip["clip_text_refined"]},
+                        ],
+                    }
+                )
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if prefetcher is not None:
+        prefetcher.close()
 
     with open(args.egoclip_dataset, "w") as out_file:
         json.dump(dataset, out_file)
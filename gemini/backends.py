@@ -0,0 +1,196 @@
+"""Generation backends of generate_gemini_data.py.
+
+Every backend has a `generate(clip_uri, instruction)` coroutine returning the
+response as a dict in the format of the Gemini responses, so the request loop
+and the post-processing do not depend on where the responses come from:
+- vertex: Gemini on VertexAI.
+- openai: any OpenAI-compatible chat completions endpoint accepting video URLs,
+  such as a local vLLM server.
+- mock: canned responses returned after a random latency, failing at given
+  rates, to measure and tune the request loop without any quota.
+"""
+
+import asyncio
+import json
+import os
+import random
+import urllib.error
+import urllib.request
+
+from response_store import ResponseStore, expand_response
+
+BACKENDS = ("vertex", "openai", "mock")
+
+DEFAULT_MOCK_RESPONSE = {
+    "candidates": [
+        {
+            "content": {
+                "role": "model",
+                "parts": [
+                    {
+                        "text": "Category: object recognition\n"
+                        "Question: What is the person holding?\n"
+                        "Short answer: A cup"
+                    }
+                ],
+            },
+            "finish_reason": "STOP",
+        }
+    ],
+    "usage_metadata": {
+        "prompt_token_count": 4000,
+        "candidates_token_count": 200,
+        "total_token_count": 4200,
+    },
+}
+
+
+class VertexBackend:
+    def __init__(self, project, location, model_name, generation_config=None):
+        import vertexai
+        from vertexai.generative_models import GenerativeModel, Part
+
+        vertexai.init(project=project, location=location)
+        self._model = GenerativeModel(model_name)
+        self._part_class = Part
+        self._generation_config = generation_config
+
+    async def generate(self, clip_uri, instruction):
+        clip = self._part_class.from_uri(uri=clip_uri, mime_type="video/mp4")
+        response = await self._model.generate_content_async(
+            [clip, instruction], generation_config=self._generation_config
+        )
+        return response.to_dict()
+
+
+class HTTPStatusError(Exception):
+    """HTTP error of a backend, classified by its status_code for retrying."""
+
+    def __init__(self, status_code, message, retry_after=None):
+        super().__init__(f"HTTP {status_code}: {message}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class OpenAIBackend:
+    def __init__(
+        self, base_url, model_name, api_key=None, generation_config=None, timeout=300
+    ):
+        self._url = f"{base_url.rstrip('/')}/chat/completions"
+        self._model_name = model_name
+        self._api_key = api_key
+        self._generation_config = generation_config or {}
+        self._timeout = timeout
+
+    def _post(self, body):
+        headers = {"Content-Type": "application/json"}
+        if self._api_key:
+            headers["Authorization"] = f"Bearer {self._api_key}"
+
+        request = urllib.request.Request(
+            self._url, data=json.dumps(body).encode(), headers=headers
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            raise HTTPStatusError(
+                e.code, e.read().decode(errors="replace"), e.headers.get("Retry-After")
+            ) from e
+
+    async def generate(self, clip_uri, instruction):
+        body = {
+            "model": self._model_name,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "video_url", "video_url": {"url": clip_uri}},
+                        {"type": "text", "text": instruction},
+                    ],
+                }
+            ],
+            **self._generation_config,
+        }
+        completion = await asyncio.to_thread(self._post, body)
+
+        # Converted to the format of the Gemini responses
+        usage = completion.get("usage") or {}
+        return {
+            "candidates": [
+                {
+                    "content": {
+                        "role": "model",
+                        "parts": [{"text": choice["message"]["content"] or ""}],
+                    },
+                    "finish_reason": (choice.get("finish_reason") or "").upper(),
+                }
+                for choice in completion["choices"]
+            ],
+            "usage_metadata": {
+                "prompt_token_count": usage.get("prompt_tokens"),
+                "candidates_token_count": usage.get("completion_tokens"),
+                "total_token_count": usage.get("total_tokens"),
+            },
+        }
+
+
+class MockBackend:
+    """Returns canned responses after a latency drawn uniformly in
+    [latency_sec * (1 - latency_jitter), latency_sec * (1 + latency_jitter)].
+
+    The requests fail with a transient error (HTTP 503) at transient_error_rate
+    and with a quota error (HTTP 429) at quota_error_rate. The canned responses
+    are the ones of a responses file of generate_gemini_data.py when given, in
+    either output format: a JSON file, its JSONL journal, or a compact response
+    store directory or its journal.
+    """
+
+    def __init__(
+        self,
+        responses_path=None,
+        latency_sec=1.0,
+        latency_jitter=0.5,
+        transient_error_rate=0.0,
+        quota_error_rate=0.0,
+        quota_retry_after_sec=1.0,
+        seed=None,
+    ):
+        self._responses = [DEFAULT_MOCK_RESPONSE]
+        if responses_path is not None:
+            if os.path.isdir(responses_path):
+                records = list(ResponseStore(responses_path))
+            else:
+                with open(responses_path) as in_file:
+                    if responses_path.endswith(".jsonl"):
+                        records = [json.loads(line) for line in in_file if line.strip()]
+                    else:
+                        records = json.load(in_file)
+            # The compact records only keep the text and usage of a response
+            self._responses = [
+                record["response"] if "response" in record else expand_response(record)
+                for record in records
+            ]
+
+        self._latency_sec = latency_sec
+        self._latency_jitter = latency_jitter
+        self._transient_error_rate = transient_error_rate
+        self._quota_error_rate = quota_error_rate
+        self._quota_retry_after_sec = quota_retry_after_sec
+        self._random = random.Random(seed)
+
+    async def generate(self, clip_uri, instruction):
+        await asyncio.sleep(
+            self._latency_sec
+            * self._random.uniform(1 - self._latency_jitter, 1 + self._latency_jitter)
+        )
+
+        draw = self._random.random()
+        if draw < self._quota_error_rate:
+            raise HTTPStatusError(
+                429, "Mock quota exceeded", retry_after=self._quota_retry_after_sec
+            )
+        if draw < self._quota_error_rate + self._transient_error_rate:
+            raise HTTPStatusError(503, "Mock service unavailable")
+
+        return self._random.choice(self._responses)
@@ -0,0 +1,260 @@
+"""Batch prediction of the Gemini requests.
+
+Rather than sending one request per clip within the per-minute quotas, the
+requests are written as sharded JSONL batch inputs, submitted as a single
+batch job, and its results are streamed back once it is over. The job runs
+under the batch prediction quotas, so the request rate is no longer the
+bottleneck of large runs.
+
+A batch runner submits the job of the input shards, polls its state and
+reads its results. VertexBatchRunner runs it with Vertex AI batch prediction,
+and LocalBatchRunner answers it from files with a generation backend, so the
+batch mode can be tested without Google Cloud.
+
+Every input line holds a request in the format of the Vertex AI batch
+prediction of Gemini, and every result line the same request along with its
+response or the status of its error:
+
+    {"request": {"contents": [...], "generationConfig": {...}}}
+    {"request": {...}, "response": {"candidates": [...]}, "status": ""}
+"""
+
+import asyncio
+import json
+import os
+import re
+import threading
+import uuid
+
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+def batch_request(clip_uri, instruction, generation_config=None):
+    """Returns the batch input line of a clip."""
+    request = {
+        "contents": [
+            {
+                "role": "user",
+                "parts": [
+                    {"fileData": {"fileUri": clip_uri, "mimeType": "video/mp4"}},
+                    {"text": instruction},
+                ],
+            }
+        ]
+    }
+    if generation_config:
+        request["generationConfig"] = generation_config
+    return {"request": request}
+
+
+def request_clip_uri(request):
+    """Returns the clip URI of a batch request, which identifies its example
+    in the results."""
+    return request["contents"][0]["parts"][0]["fileData"]["fileUri"]
+
+
+def request_instruction(request):
+    return request["contents"][0]["parts"][1]["text"]
+
+
+def snake_case_keys(value):
+    """Returns a batch response with the snake_case keys of the responses of
+    the online API, e.g. usageMetadata as usage_metadata."""
+    if isinstance(value, dict):
+        return {
+            re.sub(r"(?<!^)([A-Z])", r"_\1", key).lower(): snake_case_keys(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [snake_case_keys(item) for item in value]
+    return value
+
+
+def write_batch_shards(lines, batch_dir, shard_size):
+    """Writes the batch input lines as JSONL shards of shard_size lines, and
+    returns the paths of the shards."""
+    os.makedirs(batch_dir, exist_ok=True)
+    shard_paths = []
+    shard_file = None
+
+    for i, line in enumerate(lines):
+        if i % shard_size == 0:
+            if shard_file is not None:
+                shard_file.close()
+            shard_paths.append(
+                os.path.join(batch_dir, f"input-{len(shard_paths):05d}.jsonl")
+            )
+            shard_file = open(shard_paths[-1], "w")
+        shard_file.write(json.dumps(line) + "\n")
+
+    if shard_file is not None:
+        shard_file.close()
+
+    return shard_paths
+
+
+class VertexBatchRunner:
+    """Runs the batch jobs with Vertex AI batch prediction, uploading the input
+    shards to and reading the results from a GCS bucket."""
+
+    def __init__(self, project, location, model_name, bucket_name, prefix="batch"):
+        from google.cloud import aiplatform, storage
+
+        aiplatform.init(project=project, location=location)
+        self._aiplatform = aiplatform
+        self._model_name = f"publishers/google/models/{model_name}"
+        self._storage_client = storage.Client(project=project)
+        self._bucket = self._storage_client.bucket(bucket_name)
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+
+    def submit(self, shard_paths):
+        """Submits the job of the input shards and returns its id."""
+        run_prefix = f"{self._prefix}/{uuid.uuid4().hex}"
+        input_uris = []
+        for shard_path in shard_paths:
+            blob_name = f"{run_prefix}/inputs/{os.path.basename(shard_path)}"
+            self._bucket.blob(blob_name).upload_from_filename(shard_path)
+            input_uris.append(f"gs://{self._bucket_name}/{blob_name}")
+
+        job = self._aiplatform.BatchPredictionJob.create(
+            job_display_name=f"ego4d-vqa-gemini-{os.path.basename(run_prefix)}",
+            model_name=self._model_name,
+            instances_format="jsonl",
+            predictions_format="jsonl",
+            gcs_source=input_uris,
+            gcs_destination_prefix=f"gs://{self._bucket_name}/{run_prefix}/outputs",
+            sync=False,
+        )
+        job.wait_for_resource_creation()
+        return job.resource_name
+
+    def poll(self, job_id):
+        """Returns the state of a job."""
+        state = self._aiplatform.BatchPredictionJob(job_id).state.name
+        if state == "JOB_STATE_SUCCEEDED":
+            return JOB_SUCCEEDED
+        if state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+            return JOB_FAILED
+        return JOB_RUNNING
+
+    def read_results(self, job_id):
+        """Yields the result lines of a succeeded job."""
+        job = self._aiplatform.BatchPredictionJob(job_id)
+        output_dir = job.output_info.gcs_output_directory
+        bucket_name, _, prefix = output_dir[len("gs://") :].partition("/")
+
+        for blob in self._storage_client.list_blobs(bucket_name, prefix=prefix):
+            if not blob.name.endswith(".jsonl"):
+                continue
+            with blob.open("r") as result_file:
+                for line in result_file:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+class LocalBatchRunner:
+    """Runs the batch jobs locally with a generation backend, keeping the
+    inputs, the state and the results of every job in files of work_dir.
+
+    A job is answered in a background thread, so it is polled like a remote
+    one, and its state survives the process like the one of a remote job: a
+    running job left by a previous process is taken over when polled, skipping
+    the shards already answered.
+    """
+
+    def __init__(self, backend, work_dir, concurrency=16):
+        self._backend = backend
+        self._work_dir = work_dir
+        self._concurrency = concurrency
+        self._threads = {}
+        os.makedirs(work_dir, exist_ok=True)
+
+    def _job_dir(self, job_id):
+        return os.path.join(self._work_dir, job_id)
+
+    def _write_state(self, job_id, state):
+        state_path = os.path.join(self._job_dir(job_id), "state")
+        with open(f"{state_path}.part", "w") as state_file:
+            state_file.write(state)
+        os.replace(f"{state_path}.part", state_path)
+
+    def submit(self, shard_paths):
+        """Submits the job of the input shards and returns its id."""
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._job_dir(job_id))
+        with open(os.path.join(self._job_dir(job_id), "inputs"), "w") as inputs_file:
+            json.dump([os.path.abspath(path) for path in shard_paths], inputs_file)
+        self._write_state(job_id, JOB_RUNNING)
+
+        self._start(job_id)
+        return job_id
+
+    def _start(self, job_id):
+        self._threads[job_id] = threading.Thread(
+            target=self._run, args=(job_id,), daemon=True
+        )
+        self._threads[job_id].start()
+
+    def _run(self, job_id):
+        try:
+            asyncio.run(self._answer(job_id))
+        except Exception as e:
+            print(f"Local batch job {job_id} failed: {e!r}")
+            self._write_state(job_id, JOB_FAILED)
+        else:
+            self._write_state(job_id, JOB_SUCCEEDED)
+
+    async def _answer(self, job_id):
+        with open(os.path.join(self._job_dir(job_id), "inputs")) as inputs_file:
+            shard_paths = json.load(inputs_file)
+
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def answer(line):
+            request = line["request"]
+            async with semaphore:
+                try:
+                    response = await self._backend.generate(
+                        request_clip_uri(request), request_instruction(request)
+                    )
+                except Exception as e:
+                    return {"request": request, "status": repr(e)}
+            return {"request": request, "response": response, "status": ""}
+
+        for i, shard_path in enumerate(shard_paths):
+            # Renamed once complete, so only complete result files are read
+            results_path = os.path.join(
+                self._job_dir(job_id), f"predictions-{i:05d}.jsonl"
+            )
+            if os.path.exists(results_path):
+                continue
+
+            with open(shard_path) as shard_file:
+                lines = [json.loads(line) for line in shard_file if line.strip()]
+            results = await asyncio.gather(*(answer(line) for line in lines))
+
+            with open(f"{results_path}.part", "w") as results_file:
+                for result in results:
+                    results_file.write(json.dumps(result) + "\n")
+            os.replace(f"{results_path}.part", results_path)
+
+    def poll(self, job_id):
+        """Returns the state of a job."""
+        with open(os.path.join(self._job_dir(job_id), "state")) as state_file:
+            state = state_file.read()
+
+        if state == JOB_RUNNING and job_id not in self._threads:
+            self._start(job_id)
+        return state
+
+    def read_results(self, job_id):
+        """Yields the result lines of a succeeded job."""
+        for filename in sorted(os.listdir(self._job_dir(job_id))):
+            if filename.startswith("predictions-") and filename.endswith(".jsonl"):
+                with open(os.path.join(self._job_dir(job_id), filename)) as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
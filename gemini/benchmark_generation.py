@@ -0,0 +1,177 @@
+"""Load benchmark of the request loop of generate_gemini_data.py.
+
+The requests are sent to the mock backend, so the sustained throughput of the
+loop can be measured under any concurrency and quota settings without using
+the VertexAI quota. Every response is journaled as in generate_gemini_data.py,
+so the journal writes are included in the measure.
+
+    python ./benchmark_generation.py --concurrency 4 16 64 --vertexai_quota 60 600
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+
+from backends import MockBackend
+from journal import JsonlJournal
+from metrics import RequestMetrics
+from request_engine import RequestEngine
+from retry import RetryPolicy
+
+
+def parse_quota(value):
+    return None if value == "none" else int(value)
+
+
+def run_benchmark(
+    backend,
+    num_requests,
+    concurrency,
+    requests_per_minute,
+    tokens_per_minute,
+    tokens_per_request,
+    journal_dir,
+):
+    """Sends num_requests mock requests through the request engine and returns
+    its metrics snapshot, along with the wall time of the run."""
+    examples = [
+        {"id": i, "video_filename": f"clip_{i}.mp4"} for i in range(num_requests)
+    ]
+    metrics = RequestMetrics()
+    # Retried quickly, so that the delays measured are the ones of the quotas
+    engine = RequestEngine(
+        lambda example: backend.generate(example["video_filename"], ""),
+        concurrency=concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        tokens_per_request=tokens_per_request,
+        retry_policy=RetryPolicy(base_delay_sec=0.1, quota_base_delay_sec=1.0),
+        metrics=metrics,
+    )
+
+    journal_path = os.path.join(journal_dir, f"responses_{concurrency}.jsonl")
+    with JsonlJournal(journal_path) as journal:
+
+        def on_response(example, response):
+            journal.append({"example": example, "response": response})
+
+        start_time = time.monotonic()
+        asyncio.run(engine.run(examples, on_response, lambda *failure: None))
+        elapsed_sec = time.monotonic() - start_time
+
+    os.remove(journal_path)
+    return metrics.snapshot(), elapsed_sec
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the sustained throughput of the Gemini request loop against a mock backend"
+    )
+    parser.add_argument(
+        "--num_requests",
+        type=int,
+        default=200,
+        help="Number of requests of every setting. Default: 200",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16, 64],
+        help="Concurrency settings to measure. Default: 1 4 16 64",
+    )
+    parser.add_argument(
+        "--vertexai_quota",
+        type=parse_quota,
+        nargs="+",
+        default=[None],
+        help="Request quotas per minute to measure, none for unlimited. Default: none",
+    )
+    parser.add_argument(
+        "--vertexai_token_quota",
+        type=parse_quota,
+        nargs="+",
+        default=[None],
+        help="Token quotas per minute to measure, none for unlimited. Default: none",
+    )
+    parser.add_argument(
+        "--tokens_per_request",
+        type=int,
+        default=8000,
+        help="Estimated tokens of a request. Default: 8000",
+    )
+    parser.add_argument(
+        "--mock_responses_path",
+        type=str,
+        default=None,
+        help="Gemini responses JSON or JSONL file replayed by the mock backend. Default: a fixed response",
+    )
+    parser.add_argument(
+        "--mock_latency_sec",
+        type=float,
+        default=1.0,
+        help="Mean latency of the mock backend. Default: 1.0",
+    )
+    parser.add_argument(
+        "--mock_latency_jitter",
+        type=float,
+        default=0.5,
+        help="Relative spread of the mock latency around its mean. Default: 0.5",
+    )
+    parser.add_argument(
+        "--mock_transient_error_rate",
+        type=float,
+        default=0.0,
+        help="Rate of the 503 errors of the mock backend. Default: 0",
+    )
+    parser.add_argument(
+        "--mock_quota_error_rate",
+        type=float,
+        default=0.0,
+        help="Rate of the 429 errors of the mock backend. Default: 0",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the mock backend. Default: 0"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'concurrency':>11} {'req/min':>8} {'tok/min':>9} {'req/s':>7} "
+        f"{'p50 s':>6} {'p95 s':>6} {'retries':>7} {'failed':>6} {'wall s':>7}"
+    )
+
+    with tempfile.TemporaryDirectory() as journal_dir:
+        for requests_per_minute, tokens_per_minute, concurrency in itertools.product(
+            args.vertexai_quota, args.vertexai_token_quota, args.concurrency
+        ):
+            backend = MockBackend(
+                responses_path=args.mock_responses_path,
+                latency_sec=args.mock_latency_sec,
+                latency_jitter=args.mock_latency_jitter,
+                transient_error_rate=args.mock_transient_error_rate,
+                quota_error_rate=args.mock_quota_error_rate,
+                quota_retry_after_sec=1.0,
+                seed=args.seed,
+            )
+            metrics, elapsed_sec = run_benchmark(
+                backend,
+                args.num_requests,
+                concurrency,
+                requests_per_minute,
+                tokens_per_minute,
+                args.tokens_per_request,
+                journal_dir,
+            )
+            print(
+                f"{concurrency:>11} {requests_per_minute or '-':>8} "
+                f"{tokens_per_minute or '-':>9} "
+                f"{metrics['responses'] / elapsed_sec:>7.2f} "
+                f"{metrics['p50_latency_sec']:>6.2f} "
+                f"{metrics['p95_latency_sec']:>6.2f} "
+                f"{sum(metrics['retries'].values()):>7} "
+                f"{sum(metrics['failures'].values()):>6} "
+                f"{elapsed_sec:>7.1f}"
+            )
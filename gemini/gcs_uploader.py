@@ -0,0 +1,161 @@
+"""Concurrent upload of the Gemini clips to GCS.
+
+A single storage client, whose connections are reused, is shared by a pool of
+uploader threads, so trimming carries on while the previous clips are being
+uploaded. Clips already in the bucket with the same size are skipped, which
+makes re-runs cheap, and the large ones are uploaded in parallel parts which
+are then composed into the final object.
+
+The uploads can be tested against a local fake GCS server, such as
+fake-gcs-server, by setting STORAGE_EMULATOR_HOST, e.g.
+STORAGE_EMULATOR_HOST=http://localhost:4443.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import storage
+
+# GCS composes at most 32 objects at once
+MAX_COMPOSE_PARTS = 32
+# Resumable uploads send chunks multiple of 256 KB
+CHUNK_SIZE_UNIT = 256 * 1024
+
+
+class GCSUploader:
+    def __init__(
+        self,
+        bucket_name,
+        num_workers=8,
+        composite_threshold_mb=64,
+        num_composite_parts=8,
+        chunk_size_mb=8,
+        skip_existing=True,
+        timeout=180,
+        client=None,
+    ):
+        self._client = client if client is not None else storage.Client()
+        self._bucket = self._client.bucket(bucket_name)
+        self._composite_threshold_bytes = int(composite_threshold_mb * 1024**2)
+        self._num_composite_parts = min(max(num_composite_parts, 2), MAX_COMPOSE_PARTS)
+        self._chunk_size = max(
+            int(chunk_size_mb * 1024**2) // CHUNK_SIZE_UNIT * CHUNK_SIZE_UNIT,
+            CHUNK_SIZE_UNIT,
+        )
+        self._skip_existing = skip_existing
+        self._timeout = timeout
+
+        self._executor = ThreadPoolExecutor(num_workers)
+        # The parts have their own threads, so that a clip waiting for its parts
+        # never holds a thread they need
+        self._parts_executor = ThreadPoolExecutor(num_workers)
+
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._uploaded_files = 0
+        self._uploaded_bytes = 0
+        self._skipped_files = 0
+        self._failed_files = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, source_file_name, destination_blob_name):
+        """Schedules the upload of a file and returns its future, whose result
+        is True if the file was uploaded and False if it was already there."""
+        return self._executor.submit(
+            self._upload, source_file_name, destination_blob_name
+        )
+
+    def _upload(self, source_file_name, destination_blob_name):
+        try:
+            file_size = os.path.getsize(source_file_name)
+
+            if self._skip_existing:
+                existing_blob = self._bucket.get_blob(
+                    destination_blob_name, timeout=self._timeout
+                )
+                if existing_blob is not None and existing_blob.size == file_size:
+                    with self._lock:
+                        self._skipped_files += 1
+                    return False
+
+            if file_size >= self._composite_threshold_bytes:
+                self._upload_composite(source_file_name, destination_blob_name)
+            else:
+                blob = self._bucket.blob(destination_blob_name)
+                blob.upload_from_filename(source_file_name, timeout=self._timeout)
+        except Exception as e:
+            print(
+                f"Failed to upload {source_file_name} to {self._bucket.name}/{destination_blob_name}: {e}"
+            )
+            with self._lock:
+                self._failed_files += 1
+            raise
+
+        with self._lock:
+            self._uploaded_files += 1
+            self._uploaded_bytes += file_size
+
+        return True
+
+    def _upload_composite(self, source_file_name, destination_blob_name):
+        """Uploads a large file in parallel resumable parts composed into the
+        destination blob."""
+        file_size = os.path.getsize(source_file_name)
+        part_size = -(-file_size // self._num_composite_parts)
+        part_blobs = [
+            self._bucket.blob(
+                f"{destination_blob_name}.part{part_index}",
+                chunk_size=self._chunk_size,
+            )
+            for part_index in range(-(-file_size // part_size))
+        ]
+
+        def upload_part(part_index):
+            with open(source_file_name, "rb") as part_file:
+                part_file.seek(part_index * part_size)
+                part_blobs[part_index].upload_from_file(
+                    part_file,
+                    size=min(part_size, file_size - part_index * part_size),
+                    timeout=self._timeout,
+                )
+
+        try:
+            for future in [
+                self._parts_executor.submit(upload_part, part_index)
+                for part_index in range(len(part_blobs))
+            ]:
+                future.result()
+
+            self._bucket.blob(destination_blob_name).compose(
+                part_blobs, timeout=self._timeout
+            )
+        finally:
+            for part_blob in part_blobs:
+                try:
+                    part_blob.delete(timeout=self._timeout)
+                except Exception:
+                    pass
+
+    def report(self):
+        """Returns a summary of the uploads and of their throughput."""
+        with self._lock:
+            elapsed_sec = max(time.monotonic() - self._start_time, 1e-9)
+            uploaded_mb = self._uploaded_bytes / 1024**2
+            return (
+                f"Uploaded {self._uploaded_files} files ({uploaded_mb:.1f} MB) in "
+                f"{elapsed_sec:.1f} s: {self._uploaded_files / elapsed_sec:.2f} files/s, "
+                f"{uploaded_mb / elapsed_sec:.2f} MB/s. Skipped {self._skipped_files} "
+                f"existing files, {self._failed_files} failed"
+            )
+
+    def close(self):
+        """Waits for the pending uploads."""
+        self._executor.shutdown(wait=True)
+        self._parts_executor.shutdown(wait=True)
@@ -1,11 +1,27 @@
 import json
-import vertexai
-from vertexai.generative_models import GenerativeModel
 from tqdm import tqdm
 import argparse
-import time
-import math
+import asyncio
 import os
+import time
+
+from backends import BACKENDS, MockBackend, OpenAIBackend, VertexBackend
+from batch import (
+    JOB_FAILED,
+    JOB_RUNNING,
+    LocalBatchRunner,
+    VertexBatchRunner,
+    batch_request,
+    request_clip_uri,
+    snake_case_keys,
+    write_batch_shards,
+)
+from journal import JsonlJournal, compact_journal, read_journal
+from metrics import RequestMetrics
+from request_engine import RequestEngine
+from response_cache import ResponseCache, request_key
+from response_store import ResponseStore, compact_response, write_response_store
+from retry import TRANSIENT, RetryPolicy
 
 
 ################################################################################
@@ -31,13 +47,19 @@ parser = argparse.ArgumentParser(
     description="Prompt Gemini Pro 1.5 to generate egocentric video understanding training data"
 )
 parser.add_argument(
-    "--gcs_project_id", type=str, required=True, help="Your Google Cloud project ID"
+    "--gcs_project_id",
+    type=str,
+    default=None,
+    help="Your Google Cloud project ID, required by the vertex backend",
 )
 parser.add_argument(
     "--gcs_bucket_name", type=str, required=True, help="GCS bucket with Ego4D NLQ clips"
 )
 parser.add_argument(
-    "--gcs_location", type=str, required=True, help="GCS location to use with VertexAI"
+    "--gcs_location",
+    type=str,
+    default=None,
+    help="GCS location to use with VertexAI, required by the vertex backend",
 )
 parser.add_argument("--resume", action="store_true", help="Resume from last clip")
 parser.add_argument(
@@ -52,6 +74,13 @@ parser.add_argument(
     default="gemini_responses.json",
     help="Output path for Gemini responses. Default: gemini_responses.json",
 )
+parser.add_argument(
+    "--output_format",
+    type=str,
+    choices=["json", "compact"],
+    default="json",
+    help="json: JSON array of the examples with their full responses, compact: directory of zstd-compressed JSONL shards of the ids with the response text and usage. Default: json",
+)
 parser.add_argument(
     "--gemini_model",
     type=str,
@@ -64,6 +93,128 @@ parser.add_argument(
     default=5,
     help="VertexAI request quota per minute. Default: 5",
 )
+parser.add_argument(
+    "--vertexai_token_quota",
+    type=int,
+    default=None,
+    help="VertexAI token quota per minute. Default: unlimited",
+)
+parser.add_argument(
+    "--tokens_per_request",
+    type=int,
+    default=8000,
+    help="Estimated tokens of a request, charged to the token quota until its response reports the actual count. Default: 8000",
+)
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=4,
+    help="Maximum number of requests in flight. Default: 4",
+)
+parser.add_argument(
+    "--backend",
+    type=str,
+    choices=BACKENDS,
+    default="vertex",
+    help="vertex: Gemini on VertexAI, openai: OpenAI-compatible chat completions endpoint, mock: canned responses for load testing. Default: vertex",
+)
+parser.add_argument(
+    "--openai_base_url",
+    type=str,
+    default="http://localhost:8000/v1",
+    help="Base URL of the openai backend. Default: http://localhost:8000/v1",
+)
+parser.add_argument(
+    "--openai_api_key",
+    type=str,
+    default=os.environ.get("OPENAI_API_KEY"),
+    help="API key of the openai backend. Default: $OPENAI_API_KEY",
+)
+parser.add_argument(
+    "--mock_responses_path",
+    type=str,
+    default=None,
+    help="Gemini responses replayed by the mock backend: a JSON or JSONL file, or a compact response store. Default: a fixed response",
+)
+parser.add_argument(
+    "--mock_latency_sec",
+    type=float,
+    default=1.0,
+    help="Mean latency of the mock backend. Default: 1.0",
+)
+parser.add_argument(
+    "--mock_transient_error_rate",
+    type=float,
+    default=0.0,
+    help="Rate of the 503 errors of the mock backend. Default: 0",
+)
+parser.add_argument(
+    "--mock_quota_error_rate",
+    type=float,
+    default=0.0,
+    help="Rate of the 429 errors of the mock backend. Default: 0",
+)
+parser.add_argument(
+    "--batch",
+    action="store_true",
+    help="Send the requests as a single batch prediction job rather than one by one within the quotas",
+)
+parser.add_argument(
+    "--batch_dir",
+    type=str,
+    default=None,
+    help="Directory of the batch input shards and of the id of the running job, which --resume polls. Default: output path + .batch",
+)
+parser.add_argument(
+    "--batch_shard_size",
+    type=int,
+    default=10000,
+    help="Number of requests per batch input shard. Default: 10000",
+)
+parser.add_argument(
+    "--batch_poll_interval_sec",
+    type=float,
+    default=60,
+    help="Seconds between two polls of the batch job. Default: 60",
+)
+parser.add_argument(
+    "--max_retries",
+    type=int,
+    default=5,
+    help="Retries of a request failing with a transient error (5xx, timeout, connection). Default: 5",
+)
+parser.add_argument(
+    "--max_quota_retries",
+    type=int,
+    default=20,
+    help="Retries of a request rejected by the quota (429). Default: 20",
+)
+parser.add_argument(
+    "--dead_letter_path",
+    type=str,
+    default=None,
+    help="JSONL file of the requests which failed for good, retried on --resume. Default: output path + .failed.jsonl",
+)
+parser.add_argument(
+    "--generation_config",
+    type=json.loads,
+    default=None,
+    help='Gemini generation config as JSON, e.g. \'{"temperature": 0.4}\'. Default: model defaults',
+)
+parser.add_argument(
+    "--response_cache_dir",
+    type=str,
+    default="gemini_response_cache",
+    help="Directory of the response cache, keyed by model, clip, instruction and generation config. Default: gemini_response_cache",
+)
+parser.add_argument(
+    "--no_response_cache", action="store_true", help="Do not use the response cache"
+)
+parser.add_argument(
+    "--cache_only",
+    action="store_true",
+    help="Replay the cached responses without calling VertexAI, skipping the clips not in the cache",
+)
 
 args = parser.parse_args()
 GCS_PROJECT_ID = args.gcs_project_id
@@ -72,8 +223,33 @@ GCS_LOCATION = args.gcs_location
 RESUME = args.resume
 NLQ_VQA_PATH = args.ego4d_vqa_gemini_path
 OUTPUT_PATH = args.output_path
+COMPACT_OUTPUT = args.output_format == "compact"
+# Append-only journal of the responses, and of the ids of their examples
+JOURNAL_PATH = f"{OUTPUT_PATH}.jsonl"
+INDEX_PATH = f"{OUTPUT_PATH}.ids"
+DEAD_LETTER_PATH = args.dead_letter_path or f"{OUTPUT_PATH}.failed.jsonl"
+BATCH = args.batch
+BATCH_DIR = args.batch_dir or f"{OUTPUT_PATH}.batch"
+BATCH_JOB_PATH = os.path.join(BATCH_DIR, "job")
+BATCH_SHARD_SIZE = args.batch_shard_size
+BATCH_POLL_INTERVAL_SEC = args.batch_poll_interval_sec
+MAX_RETRIES = args.max_retries
+MAX_QUOTA_RETRIES = args.max_quota_retries
 GEMINI_MODEL = args.gemini_model
+BACKEND = args.backend
 QUOTA = args.vertexai_quota
+TOKEN_QUOTA = args.vertexai_token_quota
+TOKENS_PER_REQUEST = args.tokens_per_request
+CONCURRENCY = args.concurrency
+GENERATION_CONFIG = args.generation_config
+RESPONSE_CACHE_DIR = None if args.no_response_cache else args.response_cache_dir
+CACHE_ONLY = args.cache_only
+
+if CACHE_ONLY and RESPONSE_CACHE_DIR is None:
+    parser.error("--cache_only requires the response cache")
+
+if BACKEND == "vertex" and not CACHE_ONLY and not (GCS_PROJECT_ID and GCS_LOCATION):
+    parser.error("the vertex backend requires --gcs_project_id and --gcs_location")
 
 
 ################################################################################
@@ -83,79 +259,267 @@ with open(NLQ_VQA_PATH, "r") as file:
 
 
 ################################################################################
-# Initialize Vertex AI
-vertexai.init(project=GCS_PROJECT_ID, location=GCS_LOCATION)
+# Initialize the backend, unless only replaying cached responses
+if CACHE_ONLY:
+    backend = None
+elif BACKEND == "vertex":
+    # Batch jobs are run by the batch runner
+    backend = (
+        None
+        if BATCH
+        else VertexBackend(
+            GCS_PROJECT_ID,
+            GCS_LOCATION,
+            GEMINI_MODEL,
+            generation_config=GENERATION_CONFIG,
+        )
+    )
+elif BACKEND == "openai":
+    backend = OpenAIBackend(
+        args.openai_base_url,
+        GEMINI_MODEL,
+        api_key=args.openai_api_key,
+        generation_config=GENERATION_CONFIG,
+    )
+else:
+    backend = MockBackend(
+        responses_path=args.mock_responses_path,
+        latency_sec=args.mock_latency_sec,
+        transient_error_rate=args.mock_transient_error_rate,
+        quota_error_rate=args.mock_quota_error_rate,
+    )
+
+# Batch jobs of the other backends are answered locally with the backend
+if not BATCH or CACHE_ONLY:
+    batch_runner = None
+elif BACKEND == "vertex":
+    batch_runner = VertexBatchRunner(
+        GCS_PROJECT_ID, GCS_LOCATION, GEMINI_MODEL, GCS_BUCKET_NAME
+    )
+else:
+    batch_runner = LocalBatchRunner(backend, os.path.join(BATCH_DIR, "local_jobs"))
 
-# Load the model
-gemini = GenerativeModel(GEMINI_MODEL)
+# The responses of the other backends are kept apart from the Gemini ones
+CACHE_MODEL = GEMINI_MODEL if BACKEND == "vertex" else f"{BACKEND}:{GEMINI_MODEL}"
+
+response_cache = ResponseCache(RESPONSE_CACHE_DIR) if RESPONSE_CACHE_DIR else None
 
 
 ################################################################################
 # Resume progress
-if RESUME and os.path.exists(OUTPUT_PATH):
-    with open(OUTPUT_PATH, "r") as file:
-        responses = json.load(file)
+def output_record(example, response):
+    if COMPACT_OUTPUT:
+        return compact_response(example["id"], CACHE_MODEL, response)
+    return {
+        "example": example,
+        "response": response,
+    }
+
+
+def record_id(record):
+    return record["id"] if COMPACT_OUTPUT else record["example"]["id"]
+
+
+if RESUME:
+    if not os.path.exists(JOURNAL_PATH) and os.path.exists(OUTPUT_PATH):
+        # Output written before the journal existed, loaded once
+        with JsonlJournal(JOURNAL_PATH) as journal:
+            if COMPACT_OUTPUT:
+                for r in ResponseStore(OUTPUT_PATH):
+                    journal.append(r)
+            else:
+                with open(OUTPUT_PATH, "r") as file:
+                    for r in json.load(file):
+                        journal.append(r)
+
+    if not os.path.exists(INDEX_PATH):
+        with JsonlJournal(INDEX_PATH) as index:
+            for r in read_journal(JOURNAL_PATH):
+                index.append(record_id(r))
 
 else:
-    responses = []
+    for path in [JOURNAL_PATH, INDEX_PATH, BATCH_JOB_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
-processed_clips = [r["example"]["id"] for r in responses]
+# The failed examples are all sent again, so only the failures of this run are
+# kept
+if os.path.exists(DEAD_LETTER_PATH):
+    os.remove(DEAD_LETTER_PATH)
+
+processed_clips = set(read_journal(INDEX_PATH))
 
 if RESUME:
     print("-----------------------------------------------------------------------")
     print(f"Skipping {len(processed_clips)} already processed!")
     print("-----------------------------------------------------------------------")
 
+journal = JsonlJournal(JOURNAL_PATH)
+index = JsonlJournal(INDEX_PATH)
+dead_letter = JsonlJournal(DEAD_LETTER_PATH, fsync_every=1)
+
 
 ################################################################################
 # Process examples
-time_limit = 60
-time_queue = []
-
-for idx, example in enumerate(tqdm(vqa, total=len(vqa))):
-    if example["id"] in processed_clips:
-        continue
-
-    # record start time
-    start_time = time.time()
-
-    # Limit the requests to the specified quota
-    if len(time_queue) == QUOTA:
-        total_time = sum(time_queue)
-        sleep_time = math.ceil(time_limit - total_time)
-        if sleep_time > 0:
-            time.sleep(sleep_time)
-        time_queue.pop(0)
-
-    clip_path = f"gs://{GCS_BUCKET_NAME}/{example['video_filename']}"
-    clip = vertexai.generative_models.Part.from_uri(
-        uri=clip_path, mime_type="video/mp4"
-    )
+def clip_uri(example):
+    return f"gs://{GCS_BUCKET_NAME}/{example['video_filename']}"
 
-    try:
-        response = gemini.generate_content([clip, INSTRUCTION])
-    except Exception:
-        time.sleep(10)
-        response = gemini.generate_content([clip, INSTRUCTION])
 
-    responses.append(
+def cache_key(example):
+    return request_key(CACHE_MODEL, clip_uri(example), INSTRUCTION, GENERATION_CONFIG)
+
+
+async def generate(example):
+    # Errors are retried by the request engine
+    response = await backend.generate(clip_uri(example), INSTRUCTION)
+
+    if response_cache is not None:
+        response_cache.put(cache_key(example), response)
+
+    return response
+
+
+pending_examples = [example for example in vqa if example["id"] not in processed_clips]
+progress_bar = tqdm(total=len(vqa), initial=len(vqa) - len(pending_examples))
+metrics = RequestMetrics()
+
+
+def on_response(example, response):
+    journal.append(output_record(example, response))
+    # After the response, a crash in between only duplicates it in the journal
+    index.append(example["id"])
+    if not BATCH:
+        progress_bar.set_postfix_str(metrics.summary(), refresh=False)
+    progress_bar.update(1)
+
+
+def on_failure(example, exception, error_class):
+    dead_letter.append(
         {
             "example": example,
-            "response": response.to_dict(),
+            "error_class": error_class,
+            "error": repr(exception),
         }
     )
+    if not BATCH:
+        progress_bar.set_postfix_str(metrics.summary(), refresh=False)
+    progress_bar.update(1)
+
+
+# The cached responses are recorded first, without using any quota
+if response_cache is not None:
+    uncached_examples = []
+    for example in pending_examples:
+        response = response_cache.get(cache_key(example))
+        if response is not None:
+            on_response(example, response)
+        else:
+            uncached_examples.append(example)
+
+    print(f"Found {len(pending_examples) - len(uncached_examples)} cached responses")
+    pending_examples = uncached_examples
+
+if CACHE_ONLY:
+    print(f"Skipping {len(pending_examples)} clips not in the cache")
+    pending_examples = []
 
-    # Output results every five responses
-    if (idx + 1) % 5 == 0:
-        # store results to JSON file
-        with open(OUTPUT_PATH, "w") as out_file:
-            json.dump(responses, out_file)
 
-    # append duration to time queue to keep requests within specified quota
-    time_queue.append(math.ceil(time.time() - start_time))
+def run_batch_job(examples):
+    # The results are matched to their examples by clip
+    examples_by_uri = {}
+    for example in examples:
+        examples_by_uri.setdefault(clip_uri(example), []).append(example)
 
-# store the last results to JSON file
-with open(OUTPUT_PATH, "w") as out_file:
-    json.dump(responses, out_file)
+    if RESUME and os.path.exists(BATCH_JOB_PATH):
+        with open(BATCH_JOB_PATH, "r") as file:
+            job_id = file.read()
+        print(f"Resuming batch job {job_id}")
+    else:
+        shard_paths = write_batch_shards(
+            (
+                batch_request(uri, INSTRUCTION, GENERATION_CONFIG)
+                for uri in examples_by_uri
+            ),
+            BATCH_DIR,
+            BATCH_SHARD_SIZE,
+        )
+        job_id = batch_runner.submit(shard_paths)
+        with open(BATCH_JOB_PATH, "w") as file:
+            file.write(job_id)
+        print(f"Submitted batch job {job_id} of {len(shard_paths)} shards")
+
+    state = batch_runner.poll(job_id)
+    while state == JOB_RUNNING:
+        time.sleep(BATCH_POLL_INTERVAL_SEC)
+        state = batch_runner.poll(job_id)
+
+    # The examples of a failed job are sent again by the next --resume
+    if state == JOB_FAILED:
+        os.remove(BATCH_JOB_PATH)
+        print(f"Batch job {job_id} failed")
+        return
+
+    for result in batch_runner.read_results(job_id):
+        for example in examples_by_uri.pop(request_clip_uri(result["request"]), []):
+            if result.get("response"):
+                response = snake_case_keys(result["response"])
+                if response_cache is not None:
+                    response_cache.put(cache_key(example), response)
+                on_response(example, response)
+            else:
+                metrics.record_failure(TRANSIENT)
+                on_failure(example, RuntimeError(result.get("status")), TRANSIENT)
+
+    for examples in examples_by_uri.values():
+        for example in examples:
+            metrics.record_failure(TRANSIENT)
+            on_failure(example, RuntimeError("No batch result"), TRANSIENT)
+
+    # Only forgotten once all of its results are journaled, as a --resume
+    # interrupted while reading them reads them again
+    os.remove(BATCH_JOB_PATH)
+
+
+if BATCH:
+    if pending_examples:
+        run_batch_job(pending_examples)
+    elif os.path.exists(BATCH_JOB_PATH):
+        # All of its results were journaled before the previous run stopped
+        os.remove(BATCH_JOB_PATH)
+else:
+    # Keep CONCURRENCY requests in flight within the request and token quotas
+    engine = RequestEngine(
+        generate,
+        concurrency=CONCURRENCY,
+        requests_per_minute=QUOTA,
+        tokens_per_minute=TOKEN_QUOTA,
+        tokens_per_request=TOKENS_PER_REQUEST,
+        retry_policy=RetryPolicy(
+            max_retries=MAX_RETRIES, max_quota_retries=MAX_QUOTA_RETRIES
+        ),
+        metrics=metrics,
+    )
+    asyncio.run(engine.run(pending_examples, on_response, on_failure))
+progress_bar.close()
+journal.close()
+index.close()
+dead_letter.close()
+
+if not BATCH:
+    print(metrics.summary())
+failures = sum(metrics.snapshot()["failures"].values())
+if failures:
+    print(f"{failures} requests failed, see {DEAD_LETTER_PATH}")
+
+# store the results, the journal is kept to resume from
+if COMPACT_OUTPUT:
+    write_response_store(read_journal(JOURNAL_PATH), OUTPUT_PATH)
+else:
+    compact_journal(
+        JOURNAL_PATH,
+        OUTPUT_PATH,
+        remove_journal=False,
+        unique_key=record_id,
+    )
 
 print("Done!")
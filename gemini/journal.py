@@ -0,0 +1,215 @@
+"""Append-only JSONL journal of the records produced by the Gemini scripts.
+
+Every record is appended as a single line, so writing the output costs the
+size of the new record rather than of the whole dataset. The journal is
+flushed after every record and fsynced in batches, and a line torn by a crash
+is ignored when it is read back. Once a run is over, the journal is compacted
+into the JSON array expected by the following scripts:
+
+    python ./journal.py [path to journal] [path to output JSON file]
+"""
+
+import argparse
+import json
+import os
+import time
+
+# Characters that can follow an element of a JSON array
+ARRAY_DELIMITERS = frozenset(" \t\n\r,]")
+
+
+def truncate_torn_record(journal_path, block_size=64 * 1024):
+    """Removes the incomplete last line left in a journal by a crash."""
+    if not os.path.exists(journal_path):
+        return
+
+    with open(journal_path, "rb+") as journal_file:
+        end = journal_file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            block_start = max(position - block_size, 0)
+            journal_file.seek(block_start)
+            block = journal_file.read(position - block_start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = block_start + newline + 1
+                break
+            position = block_start
+
+        if position != end:
+            print(f"Removing the incomplete last record of {journal_path}")
+            journal_file.truncate(position)
+
+
+class JsonlJournal:
+    def __init__(self, journal_path, fsync_every=100, fsync_interval_sec=5.0):
+        self._journal_path = journal_path
+        self._fsync_every = max(fsync_every, 1)
+        self._fsync_interval_sec = fsync_interval_sec
+        self._unsynced_records = 0
+        self._last_fsync = time.monotonic()
+
+        # Appending after a torn line would corrupt the next record
+        truncate_torn_record(journal_path)
+        self._journal_file = open(journal_path, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, record):
+        """Appends a record, which is on disk after the next fsync."""
+        self._journal_file.write(json.dumps(record) + "\n")
+        self._journal_file.flush()
+        self._unsynced_records += 1
+
+        if (
+            self._unsynced_records >= self._fsync_every
+            or time.monotonic() - self._last_fsync >= self._fsync_interval_sec
+        ):
+            self.sync()
+
+    def sync(self):
+        """Forces the appended records to disk."""
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+        self._unsynced_records = 0
+        self._last_fsync = time.monotonic()
+
+    def close(self):
+        if self._journal_file.closed:
+            return
+        self.sync()
+        self._journal_file.close()
+
+
+def read_journal(journal_path):
+    """Yields the records of a journal, skipping a last line torn by a crash."""
+    if not os.path.exists(journal_path):
+        return
+
+    with open(journal_path) as journal_file:
+        for line in journal_file:
+            if not line.endswith("\n"):
+                print(f"Ignoring the incomplete last record of {journal_path}")
+                break
+            yield json.loads(line)
+
+
+def read_json_array(json_path, chunk_size=1024 * 1024):
+    """Yields the objects of a JSON array file, such as a compacted journal,
+    reading it in chunks rather than loading the whole array."""
+    decoder = json.JSONDecoder()
+
+    with open(json_path) as json_file:
+        buffer = ""
+        position = 0
+
+        def next_token():
+            # Returns the position of the next non-whitespace character,
+            # reading more of the file as needed, or -1 at the end of the file
+            nonlocal buffer, position
+            while True:
+                while position < len(buffer) and buffer[position].isspace():
+                    position += 1
+                if position < len(buffer):
+                    return position
+                buffer = json_file.read(chunk_size)
+                position = 0
+                if not buffer:
+                    return -1
+
+        if next_token() == -1 or buffer[position] != "[":
+            raise ValueError(f"{json_path} is not a JSON array")
+        position += 1
+
+        first = True
+        while True:
+            if next_token() == -1:
+                raise ValueError(f"{json_path} ends before the end of its array")
+            if buffer[position] == "]":
+                return
+            if not first:
+                if buffer[position] != ",":
+                    raise ValueError(f"Expected ',' in {json_path}")
+                position += 1
+                next_token()
+            first = False
+
+            while True:
+                try:
+                    record, end = decoder.raw_decode(buffer, position)
+                    error = None
+                    # An element ends with a delimiter, or it is a number cut
+                    # by the end of the chunk, e.g. 2 of 23 or 1 of 1.5
+                    if end < len(buffer) and buffer[end] in ARRAY_DELIMITERS:
+                        break
+                except json.JSONDecodeError as e:
+                    # The record continues in the next chunk
+                    error = e
+                chunk = json_file.read(chunk_size)
+                if not chunk:
+                    if error is not None:
+                        raise error
+                    break
+                buffer = buffer[position:] + chunk
+                position = 0
+            position = end
+            yield record
+
+
+def compact_journal(journal_path, output_path, remove_journal=True, unique_key=None):
+    """Writes the records of a journal as a JSON array, as json.dump would, and
+    returns their number.
+
+    The array is streamed to a temporary file which then atomically replaces
+    output_path, so the previous output survives a crash during compaction.
+    When unique_key is given, only the first record of every key is kept.
+    """
+    partial_output_path = f"{output_path}.part"
+    num_records = 0
+    seen_keys = set()
+
+    with open(partial_output_path, "w") as out_file:
+        out_file.write("[")
+        for record in read_journal(journal_path):
+            if unique_key is not None:
+                key = unique_key(record)
+                if key in seen_keys:
+                    continue
+                seen_keys.add(key)
+            if num_records:
+                out_file.write(", ")
+            out_file.write(json.dumps(record))
+            num_records += 1
+        out_file.write("]")
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+    os.replace(partial_output_path, output_path)
+
+    if remove_journal and os.path.exists(journal_path):
+        os.remove(journal_path)
+
+    return num_records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compact a JSONL journal into a JSON array"
+    )
+    parser.add_argument("journal_path", type=str, help="Path to the JSONL journal")
+    parser.add_argument("output_path", type=str, help="Path to the output JSON file")
+    parser.add_argument(
+        "--keep_journal",
+        action="store_true",
+        help="Optional flag to keep the journal after compacting it",
+    )
+    args = parser.parse_args()
+
+    num_records = compact_journal(
+        args.journal_path, args.output_path, remove_journal=not args.keep_journal
+    )
+    print(f"Wrote {num_records} records to {args.output_path}")
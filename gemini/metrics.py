@@ -0,0 +1,79 @@
+"""Throughput metrics of the Gemini requests."""
+
+import threading
+import time
+from collections import Counter, deque
+
+
+def percentile(sorted_values, fraction):
+    """Returns the nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[rank]
+
+
+class RequestMetrics:
+    """Counts the responses, retries and failures of the requests, and the time
+    spent waiting for the quotas.
+
+    The latency percentiles are over the last `window` responses, so that they
+    follow the current state of the service during a long run.
+    """
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._latencies = deque(maxlen=window)
+        self._num_responses = 0
+        self._retries = Counter()
+        self._failures = Counter()
+        self._quota_wait_sec = 0.0
+
+    def record_response(self, latency_sec):
+        with self._lock:
+            self._num_responses += 1
+            self._latencies.append(latency_sec)
+
+    def record_retry(self, error_class):
+        with self._lock:
+            self._retries[error_class] += 1
+
+    def record_failure(self, error_class):
+        with self._lock:
+            self._failures[error_class] += 1
+
+    def record_quota_wait(self, wait_sec):
+        with self._lock:
+            self._quota_wait_sec += wait_sec
+
+    def snapshot(self):
+        """Returns the current metrics as a dict."""
+        with self._lock:
+            elapsed_sec = max(time.monotonic() - self._start_time, 1e-9)
+            latencies = sorted(self._latencies)
+            return {
+                "responses": self._num_responses,
+                "requests_per_sec": self._num_responses / elapsed_sec,
+                "p50_latency_sec": percentile(latencies, 0.5),
+                "p95_latency_sec": percentile(latencies, 0.95),
+                "retries": dict(self._retries),
+                "failures": dict(self._failures),
+                "quota_wait_sec": self._quota_wait_sec,
+            }
+
+    def summary(self):
+        """Returns the current metrics as a short line."""
+        metrics = self.snapshot()
+        retries = ", ".join(
+            f"{error_class} {count}"
+            for error_class, count in metrics["retries"].items()
+        )
+        return (
+            f"{metrics['requests_per_sec']:.2f} req/s, "
+            f"p50 {metrics['p50_latency_sec']:.2f}s, "
+            f"p95 {metrics['p95_latency_sec']:.2f}s, "
+            f"retries: {retries or 'none'}, "
+            f"failed: {sum(metrics['failures'].values())}, "
+            f"quota wait {metrics['quota_wait_sec']:.0f}s"
+        )
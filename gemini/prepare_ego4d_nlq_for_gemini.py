@@ -2,28 +2,22 @@ import argparse
 import json
 import math
 import os
+import sys
+from collections import deque
 
-import boto3
-from moviepy.editor import VideoFileClip
 from tqdm import tqdm
-from google.cloud import storage
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-################################################################################
-# GCS utility function
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    """Uploads a file to the bucket."""
-    try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file_name, timeout=180)
-    except Exception as e:
-        print(
-            f"Failed to upload {source_file_name} to {bucket_name}/{destination_blob_name}: {e}"
-        )
-        raise
-
+from ego4d_utils.cache import VideoCache  # noqa: E402
+from ego4d_utils.s3 import (  # noqa: E402
+    S3VideoPrefetcher,
+    make_s3_client,
+    parse_s3_path,
+)
+from ego4d_utils.trimming import TRIM_MODES, trim_clips  # noqa: E402
+from gcs_uploader import GCSUploader  # noqa: E402
+from journal import JsonlJournal, compact_journal  # noqa: E402
 
 ################################################################################
 # Parse arguments
@@ -54,6 +48,19 @@ parser.add_argument(
     default="ego4d_vqa_gemini.json",
     help="Path to output JSON file",
 )
+parser.add_argument(
+    "--journal_path",
+    type=str,
+    default=None,
+    help="Path to the JSONL journal the clips are appended to while processing, "
+    "compacted into the output JSON file at the end. Default: output JSON path + .jsonl",
+)
+parser.add_argument(
+    "--journal_fsync_every",
+    type=int,
+    default=100,
+    help="Number of clips appended to the journal between two fsyncs. Default: 100",
+)
 parser.add_argument(
     "--ego4d_aws_access_key_id",
     type=str,
@@ -78,13 +85,68 @@ parser.add_argument(
     required=True,
     help="GCS bucket the clips will be saved to",
 )
+parser.add_argument(
+    "--gcs_num_uploaders",
+    type=int,
+    default=8,
+    help="Number of threads uploading the clips to GCS. Default: 8",
+)
+parser.add_argument(
+    "--gcs_composite_threshold_mb",
+    type=float,
+    default=64,
+    help="Size in MB from which clips are uploaded in parallel parts composed on GCS. "
+    "Default: 64",
+)
+parser.add_argument(
+    "--gcs_overwrite",
+    action="store_true",
+    help="Optional flag to upload the clips already in the GCS bucket again",
+)
 parser.add_argument(
     "--keep-local-clips",
     action="store_true",
     help="Optional flag to specify keeping the clips locally (requires about 130 Gb of storage)",
 )
+parser.add_argument(
+    "--trim_mode",
+    type=str,
+    choices=TRIM_MODES,
+    default="reencode",
+    help="reencode: frame accurate re-encoding, copy: stream copy from the preceding "
+    "keyframe, keyframe: stream copy with only the leading partial GOP re-encoded. "
+    "Default: reencode",
+)
+parser.add_argument(
+    "--num_prefetch",
+    type=int,
+    default=2,
+    help="Number of source videos downloaded ahead of the one being trimmed. Default: 2",
+)
+parser.add_argument(
+    "--prefetch_max_gb",
+    type=float,
+    default=None,
+    help="Disk budget in GB of the prefetched source videos. Default: unlimited",
+)
+parser.add_argument(
+    "--cache_dir",
+    type=str,
+    default=None,
+    help="Directory of a persistent source video cache, which can be shared with the "
+    "other Ego4D preparation scripts. Default: no cache",
+)
+parser.add_argument(
+    "--cache_max_gb",
+    type=float,
+    default=None,
+    help="Disk budget in GB of the source video cache. Default: unlimited",
+)
 args = parser.parse_args()
 
+if args.journal_path is None:
+    args.journal_path = f"{args.output_json_path}.jsonl"
+
 
 ################################################################################
 # Load the data
@@ -98,47 +160,98 @@ with open(args.ego4d_nlq_path) as in_file:
 
 ################################################################################
 # Process videos
-dataset = []
+num_clips = 0
 
-# init JSON file
-with open(args.output_json_path, "w") as in_file:
+# init JSONL journal
+with open(args.journal_path, "w") as out_file:
     pass
 
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=args.ego4d_aws_access_key_id,
-    aws_secret_access_key=args.ego4d_aws_secret_access_key,
-    region_name=args.ego4d_aws_region_name,
-)
-
-last_downloaded_video_filename = None
-
-for video in tqdm(ego4d_nlq["videos"], total=len(ego4d_nlq["videos"])):
-    for clip in video["clips"]:
-        for annotation in clip["annotations"]:
-            for language_query_index, language_query in enumerate(
-                annotation["language_queries"]
-            ):
-                idx = len(dataset)
-                try:
-                    s3_video_path_parts = video_uid2video[video["video_uid"]][
-                        "s3_path"
-                    ].split("/")
-                    s3_bucket_name = s3_video_path_parts[2]
-                    s3_key = "/".join(s3_video_path_parts[3:])
-                    s3_filename = s3_video_path_parts[-3]
-
-                    video_filename = os.path.join(
-                        args.ego4d_output_videos_path,
-                        video["video_uid"],
-                    )
+s3 = make_s3_client(
+    args.ego4d_aws_access_key_id,
+    args.ego4d_aws_secret_access_key,
+    args.ego4d_aws_region_name,
+)
+
+# Only the videos with language queries are downloaded
+nlq_videos = [
+    video
+    for video in ego4d_nlq["videos"]
+    if any(
+        annotation["language_queries"]
+        for clip in video["clips"]
+        for annotation in clip["annotations"]
+    )
+]
+
+prefetcher = S3VideoPrefetcher(
+    s3,
+    [
+        (
+            video["video_uid"],
+            *parse_s3_path(video_uid2video[video["video_uid"]]["s3_path"]),
+        )
+        for video in nlq_videos
+    ],
+    num_prefetch=args.num_prefetch,
+    max_disk_gb=args.prefetch_max_gb,
+    cache=(
+        VideoCache(args.cache_dir, max_gb=args.cache_max_gb)
+        if args.cache_dir is not None
+        else None
+    ),
+)
+
+journal = JsonlJournal(args.journal_path, fsync_every=args.journal_fsync_every)
+
+uploader = GCSUploader(
+    args.gcs_bucket_name,
+    num_workers=args.gcs_num_uploaders,
+    composite_threshold_mb=args.gcs_composite_threshold_mb,
+    skip_existing=not args.gcs_overwrite,
+)
 
-                    if video_filename != last_downloaded_video_filename:
-                        if last_downloaded_video_filename:
-                            os.remove(last_downloaded_video_filename)
-                        s3.download_file(s3_bucket_name, s3_key, video_filename)
-                        last_downloaded_video_filename = video_filename
+# Clips being uploaded, as (upload future, record, clip filename) tuples
+pending_uploads = deque()
 
+
+def journal_uploaded_clips(max_pending=0):
+    """Appends the uploaded clips to the journal in the order they were trimmed,
+    waiting for the oldest uploads while more than max_pending are left."""
+    global num_clips
+
+    while pending_uploads and (
+        len(pending_uploads) > max_pending or pending_uploads[0][0].done()
+    ):
+        upload, record, clip_filename = pending_uploads.popleft()
+        try:
+            upload.result()
+
+            journal.append({"id": num_clips, **record})
+            num_clips += 1
+
+            if not args.keep_local_clips:
+                os.remove(clip_filename)
+
+        except Exception as e:
+            print(f"Error with {num_clips}!")
+            print(e)
+
+
+with prefetcher, journal, uploader:
+    for video, (video_uid, video_filename) in tqdm(
+        zip(nlq_videos, prefetcher), total=len(nlq_videos)
+    ):
+        if video_filename is None:
+            continue
+
+        # All the queries of the video are trimmed together, so that
+        # overlapping clips are decoded only once
+        queries = []
+        for clip in video["clips"]:
+            for annotation in clip["annotations"]:
+                for language_query_index, language_query in enumerate(
+                    annotation["language_queries"]
+                ):
                     video_start_sec = max(
                         math.floor(language_query["video_start_sec"]),
                         0,
@@ -155,62 +268,78 @@ for video in tqdm(ego4d_nlq["videos"], total=len(ego4d_nlq["videos"])):
                         annotation["annotation_uid"],
                         f"{language_query_index}.mp4",
                     )
+                    os.makedirs(os.path.dirname(clip_filename), exist_ok=True)
 
-                    video_clip = VideoFileClip(last_downloaded_video_filename)
-                    video_clip = video_clip.subclip(video_start_sec, video_end_sec)
-                    video_clip.write_videofile(
-                        clip_filename, remove_temp=True, logger=None
+                    queries.append(
+                        (
+                            clip,
+                            annotation,
+                            language_query_index,
+                            language_query,
+                            (video_start_sec, video_end_sec, clip_filename),
+                        )
                     )
 
-                    # Upload to GCS
-                    if args.gcs_bucket_name:
-                        upload_blob(args.gcs_bucket_name, clip_filename, clip_filename)
+        errors = trim_clips(
+            video_filename,
+            [query[-1] for query in queries],
+            trim_mode=args.trim_mode,
+        )
+
+        for (
+            clip,
+            annotation,
+            language_query_index,
+            language_query,
+            (_, _, clip_filename),
+        ), error in zip(queries, errors):
+            if error is not None:
+                print(f"Error with {clip_filename}!")
+                print(error)
+                continue
 
-                    human_value = (f"<video>\n",)
-                    if "query" in language_query:
-                        human_value = f"<video>\n{language_query['query']}"
+            human_value = (f"<video>\n",)
+            if "query" in language_query:
+                human_value = f"<video>\n{language_query['query']}"
 
-                    gpt_value = ""
-                    if "answer" in language_query:
-                        gpt_value = language_query["answer"].replace(
-                            "Answer (Optional):", ""
-                        )
+            gpt_value = ""
+            if "answer" in language_query:
+                gpt_value = language_query["answer"].replace("Answer (Optional):", "")
 
-                    dataset.append(
-                        {
-                            "id": idx,
-                            "video_uid": video["video_uid"],
-                            "clip_uid": clip["clip_uid"],
-                            "annotation_uid": annotation["annotation_uid"],
-                            "language_query_index": language_query_index,
-                            "video_filename": clip_filename,
-                            "conversations": [
-                                {
-                                    "from": "human",
-                                    "value": human_value,
-                                },
-                                {
-                                    "from": "gpt",
-                                    "value": gpt_value,
-                                },
-                            ],
-                        }
-                    )
+            # Upload to GCS, the clip is added to the dataset once uploaded
+            pending_uploads.append(
+                (
+                    uploader.submit(clip_filename, clip_filename),
+                    {
+                        "video_uid": video["video_uid"],
+                        "clip_uid": clip["clip_uid"],
+                        "annotation_uid": annotation["annotation_uid"],
+                        "language_query_index": language_query_index,
+                        "video_filename": clip_filename,
+                        "conversations": [
+                            {
+                                "from": "human",
+                                "value": human_value,
+                            },
+                            {
+                                "from": "gpt",
+                                "value": gpt_value,
+                            },
+                        ],
+                    },
+                    clip_filename,
+                )
+            )
 
-                    with open(args.output_json_path, "w") as out_file:
-                        json.dump(dataset, out_file)
+        # Trimming goes on while the clips are uploaded, up to a bounded backlog
+        journal_uploaded_clips(max_pending=4 * args.gcs_num_uploaders)
 
-                    if not args.keep_local_clips:
-                        os.remove(clip_filename)
+        prefetcher.release(video_uid)
 
-                except Exception as e:
-                    print(f"Error with {idx}!")
-                    print(e)
+    journal_uploaded_clips()
 
-if os.path.exists(last_downloaded_video_filename):
-    os.remove(last_downloaded_video_filename)
+print(uploader.report())
 
-with open(args.output_json_path, "w") as out_file:
-    json.dump(dataset, out_file)
+compact_journal(args.journal_path, args.output_json_path)
 
 print("Done!")
@@ -1,10 +1,13 @@
 import math
 import random
 import json
-import copy
 import argparse
+import multiprocessing
 import os
 
+from journal import read_journal, read_json_array
+from response_store import ResponseStore
+
 random.seed(42)
 
 
@@ -19,59 +22,108 @@ def sort_dicts_by_category_list(dict_list, category_list):
     return sorted_dicts
 
 
-def preprocess_data(gen_data):
-    """Process the generated text - check how many responses fit the expected format and return the missing data too"""
-    categories = [
-        "object recognition",
-        "attribute recognition",
-        "object state recognition",
-        "object localisation",
-        "spatial reasoning",
-        "functional reasoning",
-        "world knowledge",
-    ]
+CATEGORIES = [
+    "object recognition",
+    "attribute recognition",
+    "object state recognition",
+    "object localisation",
+    "spatial reasoning",
+    "functional reasoning",
+    "world knowledge",
+]
 
-    processed_data = []
-    missing = []
 
+def lean_records(gen_data):
+    """Reduce every response to its example and the text of its first candidate,
+    which is None when the response has no content"""
     for g in gen_data:
-        try:
-            if len(g["response"]["candidates"]) < 1:
-                missing.append(g)
-                continue
-            if "content" not in g["response"]["candidates"][0]:
-                missing.append(g)
-                continue
-
-            response = g["response"]["candidates"][0]["content"]["parts"][0]["text"]
-            category_data = response.split("\n\n")
-            examples = []
-
-            for c_data in category_data:
-                c_lines = c_data.splitlines()
-                # drop empty lines
-                c_lines = [c_line for c_line in c_lines if bool(c_line)]
-                example = {}
-                for c_line in c_lines:
-                    key, value = c_line.split(": ", 1)
-                    example[key.strip().lower()] = (
-                        value.strip().lower().replace("localization", "localisation")
-                    )
-                examples.append(example)
-
-            # set the order of the examples to categories
-            sorted_examples = sort_dicts_by_category_list(examples, categories)
-
-            for example, category in zip(sorted_examples, categories):
-                assert category == example["category"].lower()
+        candidates = g["response"]["candidates"]
+        if len(candidates) < 1 or "content" not in candidates[0]:
+            yield g["example"], None
+        else:
+            yield g["example"], candidates[0]["content"]["parts"][0]["text"]
+
+
+def read_lean_records(gen_data_path, ego4d_vqa_gemini_path):
+    """Stream the lean records of the Gemini responses from a compact response
+    store, a JSON array or a JSONL journal
+
+    The compact records only hold the ids of their examples, which are read
+    from ego4d_vqa_gemini.json"""
+    if os.path.isdir(gen_data_path):
+        with open(ego4d_vqa_gemini_path, "r") as file:
+            id2example = {example["id"]: example for example in json.load(file)}
+        for r in ResponseStore(gen_data_path):
+            yield id2example[r["id"]], r["text"]
+    elif gen_data_path.endswith(".jsonl"):
+        yield from lean_records(read_journal(gen_data_path))
+    else:
+        yield from lean_records(read_json_array(gen_data_path))
+
+
+def parse_response(record):
+    """Parse the category/question/answer blocks of a response text, sorted in
+    the order of the categories"""
+    example, response = record
+    if response is None:
+        return example, None
+
+    try:
+        category_data = response.split("\n\n")
+        examples = []
+
+        for c_data in category_data:
+            c_lines = c_data.splitlines()
+            # drop empty lines
+            c_lines = [c_line for c_line in c_lines if bool(c_line)]
+            c_example = {}
+            for c_line in c_lines:
+                key, value = c_line.split(": ", 1)
+                c_example[key.strip().lower()] = (
+                    value.strip().lower().replace("localization", "localisation")
+                )
+            examples.append(c_example)
+
+        # set the order of the examples to categories
+        sorted_examples = sort_dicts_by_category_list(examples, CATEGORIES)
+
+        for c_example, category in zip(sorted_examples, CATEGORIES):
+            assert category == c_example["category"].lower()
+
+    except Exception:
+        print({"example": example, "response": response})
+        raise
+
+    return example, sorted_examples
+
+
+def preprocess_data(records, num_workers=1):
+    """Process the generated text - check how many responses fit the expected format and return the missing data too
+
+    The lean records are parsed in num_workers processes, keeping only the
+    examples and their parsed text."""
+    processed_data = []
+    missing = []
 
-            pd = copy.deepcopy(g)
-            pd["processed_examples"] = sorted_examples
-            processed_data.append(pd)
+    pool = None
+    if num_workers > 1:
+        # imap hands the responses back in order to keep the dataset stable
+        pool = multiprocessing.Pool(num_workers)
+        parsed_records = pool.imap(parse_response, records, 256)
+    else:
+        parsed_records = map(parse_response, records)
+
+    for example, processed_examples in parsed_records:
+        if processed_examples is None:
+            missing.append(example)
+        else:
+            processed_data.append(
+                {"example": example, "processed_examples": processed_examples}
+            )
 
-        except Exception:
-            print(g)
-            raise
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     if len(missing) > 0:
         print(f"There are {len(missing)} examples which do not have a Gemini response")
@@ -79,31 +131,82 @@ def preprocess_data(gen_data):
     return processed_data, missing
 
 
-def prepare_durations(train, missing_data, video_uid2video):
-    """Get the durations, indexed by clip ID"""
-    missing_keys = [
-        f"{m['example']['video_uid']}-{m['example']['clip_uid']}-{m['example']['annotation_uid']}-{m['example']['language_query_index']}"
-        for m in missing_data
-    ]
+def nlq_query_key(example):
+    """Key of the NLQ language query of an example in the duration index"""
+    return (
+        example["video_uid"],
+        example["clip_uid"],
+        example["annotation_uid"],
+        example["language_query_index"],
+    )
+
 
+def prepare_durations(train, video_uid2video):
+    """Get the durations of all the NLQ language queries, indexed by nlq_query_key"""
     durations = {}
     for video in train["videos"]:
+        video_duration = video_uid2video[video["video_uid"]]["duration_sec"]
         for clip in video["clips"]:
             for annotation in clip["annotations"]:
                 for language_query_index, language_query in enumerate(
                     annotation["language_queries"]
                 ):
-                    # check the video isn't in the missing set
-                    key = f"{video['video_uid']}-{clip['clip_uid']}-{annotation['annotation_uid']}-{language_query_index}"
-                    if key in missing_keys:
-                        continue
                     start = max(math.floor(language_query["video_start_sec"]), 0)
                     end = min(
-                        math.ceil(language_query["video_end_sec"]),
-                        video_uid2video[video["video_uid"]]["duration_sec"],
+                        math.ceil(language_query["video_end_sec"]), video_duration
                     )
-                    duration = end - start
-                    durations[key] = duration
+                    key = (
+                        video["video_uid"],
+                        clip["clip_uid"],
+                        annotation["annotation_uid"],
+                        language_query_index,
+                    )
+                    durations[key] = end - start
+    return durations
+
+
+def source_fingerprint(paths):
+    """Identifies the versions of the source files of a cache"""
+    fingerprint = []
+    for path in paths:
+        stat = os.stat(path)
+        fingerprint.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def load_durations(ego4d_path, nlq_train_path, cache_path=None):
+    """Load the duration index from its cache, or build it from ego4d.json and
+    nlq_train.json and cache it when they changed since it was cached"""
+    fingerprint = source_fingerprint([ego4d_path, nlq_train_path])
+
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "r") as file:
+            cache = json.load(file)
+        if cache["sources"] == fingerprint:
+            print(f"Loaded the durations from {cache_path}")
+            return {tuple(row[:-1]): row[-1] for row in cache["durations"]}
+
+    with open(ego4d_path, "r") as file:
+        meta = json.load(file)
+    video_uid2video = {video["video_uid"]: video for video in meta["videos"]}
+
+    with open(nlq_train_path, "r") as file:
+        train = json.load(file)
+
+    durations = prepare_durations(train, video_uid2video)
+
+    if cache_path is not None:
+        # Written aside and renamed, so a crash never leaves a partial cache
+        with open(f"{cache_path}.part", "w") as file:
+            json.dump(
+                {
+                    "sources": fingerprint,
+                    "durations": [[*key, value] for key, value in durations.items()],
+                },
+                file,
+            )
+        os.replace(f"{cache_path}.part", cache_path)
+
     return durations
 
 
@@ -138,8 +241,7 @@ def process_data(processed_data, durations):
     dataset = []
 
     for d in processed_data:
-        key = f"{d['example']['video_uid']}-{d['example']['clip_uid']}-{d['example']['annotation_uid']}-{d['example']['language_query_index']}"
-        duration = durations[key]
+        duration = durations[nlq_query_key(d["example"])]
         video_filename = d["example"]["video_filename"].replace(
             "ego4d_vqa_videos", "ego4d_vqa_gen_videos"
         )
@@ -170,65 +272,85 @@ def process_data(processed_data, durations):
     return dataset
 
 
-################################################################################
-# Parse arguments
-parser = argparse.ArgumentParser(description="")
-parser.add_argument(
-    "--ego4d_path",
-    type=str,
-    default="../data/ego4d.json",
-    help="Path to ego4d.json. Default: ../data/ego4d.json",
-)
-parser.add_argument(
-    "--ego4d_nlq_path",
-    type=str,
-    default="../data/nlq_train.json",
-    help="Path to nlq_train.json. Default: ../data/nlq_train.json",
-)
-parser.add_argument(
-    "--gemini_data_path",
-    type=str,
-    default="gemini_responses.json",
-    help="Path to Gemini responses. Default: gemini_responses.json",
-)
-parser.add_argument(
-    "--output_path",
-    type=str,
-    default="../output/ft_json/gemini.json",
-    help="Output path for processed data. Default: ../output/ft_json/gemini.json",
-)
-
-args = parser.parse_args()
-EGO4D_META_PATH = args.ego4d_path
-NLQ_TRAIN_PATH = args.ego4d_nlq_path
-GEN_DATA_PATH = args.gemini_data_path
-OUTPUT_PATH = args.output_path
+if __name__ == "__main__":
+    ################################################################################
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        "--ego4d_path",
+        type=str,
+        default="../data/ego4d.json",
+        help="Path to ego4d.json. Default: ../data/ego4d.json",
+    )
+    parser.add_argument(
+        "--ego4d_nlq_path",
+        type=str,
+        default="../data/nlq_train.json",
+        help="Path to nlq_train.json. Default: ../data/nlq_train.json",
+    )
+    parser.add_argument(
+        "--gemini_data_path",
+        type=str,
+        default="gemini_responses.json",
+        help="Path to Gemini responses. Default: gemini_responses.json",
+    )
+    parser.add_argument(
+        "--ego4d_vqa_gemini_path",
+        type=str,
+        default="./ego4d_vqa_gemini.json",
+        help="Path to ego4d_vqa_gemini.json, with the examples of compact Gemini responses. Default: ./ego4d_vqa_gemini.json",
+    )
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        default="../output/ft_json/gemini.json",
+        help="Output path for processed data. Default: ../output/ft_json/gemini.json",
+    )
+    parser.add_argument(
+        "--durations_cache_path",
+        type=str,
+        default="nlq_durations.json",
+        help="Cache of the NLQ query durations, rebuilt when ego4d.json or nlq_train.json change. Default: nlq_durations.json",
+    )
+    parser.add_argument(
+        "--no_durations_cache",
+        action="store_true",
+        help="Do not use the durations cache",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes parsing the responses. Default: number of CPUs",
+    )
 
+    args = parser.parse_args()
+    EGO4D_META_PATH = args.ego4d_path
+    NLQ_TRAIN_PATH = args.ego4d_nlq_path
+    GEN_DATA_PATH = args.gemini_data_path
+    NLQ_VQA_PATH = args.ego4d_vqa_gemini_path
+    OUTPUT_PATH = args.output_path
+    DURATIONS_CACHE_PATH = (
+        None if args.no_durations_cache else args.durations_cache_path
+    )
+    NUM_WORKERS = args.num_workers
 
-################################################################################
-# Load the required data
-with open(EGO4D_META_PATH, "r") as file:
-    meta = json.load(file)
-video_uid2video = {video["video_uid"]: video for video in meta["videos"]}
+    ################################################################################
+    # Load the required data
+    durations = load_durations(EGO4D_META_PATH, NLQ_TRAIN_PATH, DURATIONS_CACHE_PATH)
 
-with open(NLQ_TRAIN_PATH, "r") as file:
-    train = json.load(file)
+    records = read_lean_records(GEN_DATA_PATH, NLQ_VQA_PATH)
 
-with open(GEN_DATA_PATH, "r") as file:
-    gen_data = json.load(file)
+    ################################################################################
+    # Process data
+    processed_data, missing_data = preprocess_data(records, NUM_WORKERS)
+    dataset = process_data(processed_data, durations)
 
+    # Dump to JSON file
+    if not os.path.exists(OUTPUT_PATH):
+        os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
+    with open(OUTPUT_PATH, "w") as f:
+        json.dump(dataset, f, indent=2)
 
-################################################################################
-# Process data
-processed_data, missing_data = preprocess_data(gen_data)
-durations = prepare_durations(train, missing_data, video_uid2video)
-dataset = process_data(processed_data, durations)
-
-# Dump to JSON file
-if not os.path.exists(OUTPUT_PATH):
-    os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
-with open(OUTPUT_PATH, "w") as f:
-    json.dump(dataset, f, indent=2)
-
-print(f"Outputted {len(dataset)} to {OUTPUT_PATH}")
-print("Done!")
+    print(f"Outputted {len(dataset)} to {OUTPUT_PATH}")
+    print("Done!")
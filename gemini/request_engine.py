@@ -0,0 +1,201 @@
+"""Concurrent Gemini requests within the per-minute quotas of VertexAI.
+
+The engine keeps up to `concurrency` requests in flight, so the throughput is
+bounded by the quotas rather than by the latency of a single request. Both the
+requests per minute and the tokens per minute are enforced with token buckets.
+The tokens of a request are only known once it has been answered, so an
+estimate is taken from the bucket when it is sent and corrected with the usage
+metadata of its response.
+
+Failed requests are retried according to the class of their error, see
+retry.py, and the ones which cannot be retried are handed to on_failure rather
+than stopping the other requests.
+"""
+
+import asyncio
+import time
+
+from metrics import RequestMetrics
+from retry import QUOTA, RetryPolicy, classify_error
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute.
+
+    The bucket holds at most `capacity` tokens, a second worth of refill by
+    default, so that no more than about rate_per_minute tokens are spent over
+    any minute. A request larger than the capacity waits for a full bucket and
+    leaves it in debt, which delays the following ones.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self._rate_per_sec = rate_per_minute / 60
+        self._capacity = (
+            capacity if capacity is not None else max(self._rate_per_sec, 1)
+        )
+        self._tokens = self._capacity
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+        # Wakes up the waiting request when tokens are given back
+        self._refunded = asyncio.Event()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self._tokens + (now - self._last_refill) * self._rate_per_sec,
+            self._capacity,
+        )
+        self._last_refill = now
+
+    async def acquire(self, amount=1):
+        """Takes amount tokens, waiting for them in FIFO order, and returns the
+        number of seconds waited."""
+        start_time = time.monotonic()
+
+        async with self._lock:
+            needed = min(amount, self._capacity)
+            self._refill()
+            while self._tokens < needed:
+                self._refunded.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._refunded.wait(),
+                        (needed - self._tokens) / self._rate_per_sec,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                self._refill()
+            self._tokens -= amount
+
+        return time.monotonic() - start_time
+
+    def adjust(self, amount):
+        """Takes amount more tokens, or gives them back if negative."""
+        self._refill()
+        self._tokens = min(self._tokens - amount, self._capacity)
+        if amount < 0:
+            self._refunded.set()
+
+
+def response_token_count(response):
+    """Returns the total token count of a response dict, if it has one."""
+    return (response.get("usage_metadata") or {}).get("total_token_count")
+
+
+class RequestEngine:
+    """Sends the requests of `generate`, a coroutine function taking an example
+    and returning its response dict, within the quotas.
+
+    requests_per_minute and tokens_per_minute are None when unlimited, and
+    tokens_per_request is the estimate taken from the token bucket until a
+    response tells the actual count.
+    """
+
+    def __init__(
+        self,
+        generate,
+        concurrency=4,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        tokens_per_request=8000,
+        retry_policy=None,
+        metrics=None,
+    ):
+        self._generate = generate
+        self._concurrency = max(concurrency, 1)
+        self._requests_per_minute = requests_per_minute
+        self._tokens_per_minute = tokens_per_minute
+        self._tokens_per_request = tokens_per_request
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.metrics = metrics if metrics is not None else RequestMetrics()
+
+    async def _request(self, example, request_bucket, token_bucket):
+        """Sends the request of an example, retrying it while the policy allows,
+        and returns its response."""
+        attempt = 0
+
+        while True:
+            # Every attempt counts against the quotas
+            quota_wait_sec = 0
+            if request_bucket is not None:
+                quota_wait_sec += await request_bucket.acquire()
+            if token_bucket is not None:
+                quota_wait_sec += await token_bucket.acquire(self._tokens_per_request)
+            self.metrics.record_quota_wait(quota_wait_sec)
+
+            start_time = time.monotonic()
+            try:
+                response = await self._generate(example)
+            except Exception as e:
+                if token_bucket is not None:
+                    token_bucket.adjust(-self._tokens_per_request)
+
+                error_class = classify_error(e)
+                delay_sec = self._retry_policy.retry_delay(e, error_class, attempt)
+                if delay_sec is None:
+                    self.metrics.record_failure(error_class)
+                    raise
+
+                self.metrics.record_retry(error_class)
+                if error_class == QUOTA:
+                    self.metrics.record_quota_wait(delay_sec)
+                await asyncio.sleep(delay_sec)
+                attempt += 1
+                continue
+
+            self.metrics.record_response(time.monotonic() - start_time)
+
+            token_count = response_token_count(response)
+            if token_bucket is not None and token_count is not None:
+                token_bucket.adjust(token_count - self._tokens_per_request)
+
+            return response
+
+    async def _worker(
+        self, examples, on_response, on_failure, request_bucket, token_bucket
+    ):
+        # The workers share the iterator, each taking the next example once
+        # its previous request has been answered
+        for example in examples:
+            try:
+                response = await self._request(example, request_bucket, token_bucket)
+            except Exception as e:
+                if on_failure is None:
+                    raise
+                on_failure(example, e, classify_error(e))
+                continue
+
+            on_response(example, response)
+
+    async def run(self, examples, on_response, on_failure=None):
+        """Requests every example and calls on_response(example, response) as
+        the responses complete, which may differ from the order of examples.
+
+        The requests which failed for good are passed to on_failure(example,
+        exception, error_class), or stop the run when it is None.
+        """
+        request_bucket = (
+            TokenBucket(self._requests_per_minute)
+            if self._requests_per_minute
+            else None
+        )
+        # The token bucket holds at least one estimate, so that giving back an
+        # overestimate is not lost to the capacity
+        token_bucket = (
+            TokenBucket(
+                self._tokens_per_minute,
+                capacity=max(self._tokens_per_minute / 60, self._tokens_per_request),
+            )
+            if self._tokens_per_minute
+            else None
+        )
+
+        examples = iter(examples)
+        await asyncio.gather(
+            *(
+                self._worker(
+                    examples, on_response, on_failure, request_bucket, token_bucket
+                )
+                for _ in range(self._concurrency)
+            )
+        )
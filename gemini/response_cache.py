@@ -0,0 +1,55 @@
+"""On-disk cache of the Gemini responses, addressed by the content of the request.
+
+A response is stored under the hash of everything that determines it: the
+model name, the URI of the clip, the instruction and the generation config.
+Extending the clip list or re-running the generation with the same settings
+then only sends the requests never answered before, and changing any of them
+naturally misses the cache.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+
+def request_key(model_name, clip_uri, instruction, generation_config=None):
+    """Returns the cache key of a Gemini request."""
+    request = {
+        "model_name": model_name,
+        "clip_uri": clip_uri,
+        "instruction_sha256": hashlib.sha256(instruction.encode()).hexdigest(),
+        "generation_config": generation_config,
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _response_filename(self, key):
+        # Fan out over subdirectories to keep them small
+        return os.path.join(self._cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """Returns the cached response dict of a request key, or None."""
+        try:
+            with open(self._response_filename(key)) as in_file:
+                return json.load(in_file)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, response):
+        """Stores the response dict of a request key."""
+        response_filename = self._response_filename(key)
+        os.makedirs(os.path.dirname(response_filename), exist_ok=True)
+
+        # Written aside and renamed, so a response is never read half written
+        partial_filename = (
+            f"{response_filename}.{os.getpid()}-{threading.get_ident()}.part"
+        )
+        with open(partial_filename, "w") as out_file:
+            json.dump(response, out_file)
+        os.replace(partial_filename, response_filename)
@@ -0,0 +1,228 @@
+"""Compact compressed storage of the Gemini responses.
+
+Only what the following scripts use is kept from every response, along with
+the id of its example:
+
+    {"id": 0, "model": "gemini-1.5-pro-001", "text": "Category: ...",
+     "finish_reason": "STOP", "prompt_tokens": 4000,
+     "candidates_tokens": 200, "total_tokens": 4200}
+
+The text is None when the response has no content. The records are written
+as JSONL in zstd-compressed shards, each a sequence of independent frames of
+frame_size records, so that a shard decompresses as a whole with `zstd -dc`
+while a single record only needs its frame. index.json holds the shard, the
+offset and the length of the frame of every id, and the line of its record
+in the frame.
+
+Existing responses can be converted with:
+
+    python ./response_store.py [path to Gemini responses JSON file] [output directory]
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+import zstandard
+
+from journal import read_journal, read_json_array
+
+INDEX_FILENAME = "index.json"
+
+
+def compact_response(example_id, model_name, response):
+    """Returns the compact record of a response dict."""
+    candidates = response.get("candidates") or []
+    candidate = candidates[0] if candidates else {}
+    parts = (candidate.get("content") or {}).get("parts") or []
+    usage = response.get("usage_metadata") or {}
+
+    return {
+        "id": example_id,
+        "model": model_name,
+        "text": parts[0].get("text") if parts else None,
+        "finish_reason": candidate.get("finish_reason"),
+        "prompt_tokens": usage.get("prompt_token_count"),
+        "candidates_tokens": usage.get("candidates_token_count"),
+        "total_tokens": usage.get("total_token_count"),
+    }
+
+
+def expand_response(record):
+    """Returns a response dict holding what a compact record kept of it."""
+    candidate = {"finish_reason": record.get("finish_reason")}
+    if record.get("text") is not None:
+        candidate["content"] = {"role": "model", "parts": [{"text": record["text"]}]}
+
+    return {
+        "candidates": [candidate],
+        "usage_metadata": {
+            "prompt_token_count": record.get("prompt_tokens"),
+            "candidates_token_count": record.get("candidates_tokens"),
+            "total_token_count": record.get("total_tokens"),
+        },
+    }
+
+
+def write_response_store(
+    records, store_dir, shard_size=10000, frame_size=256, level=10
+):
+    """Writes compact records into a response store, keeping the first record
+    of every id, and returns the number of records written.
+
+    The store is written aside and then replaces store_dir, so the previous
+    store survives a crash while writing."""
+    partial_store_dir = f"{store_dir}.part"
+    if os.path.exists(partial_store_dir):
+        shutil.rmtree(partial_store_dir)
+    os.makedirs(partial_store_dir)
+
+    compressor = zstandard.ZstdCompressor(level=level)
+    shards = []
+    index = {}
+    shard_file = None
+    frame = []
+    written_ids = set()
+
+    def write_frame():
+        offset = shard_file.tell()
+        shard_file.write(
+            compressor.compress(
+                "".join(json.dumps(record) + "\n" for record in frame).encode()
+            )
+        )
+        length = shard_file.tell() - offset
+        for line, record in enumerate(frame):
+            index[record["id"]] = [len(shards) - 1, offset, length, line]
+        frame.clear()
+
+    num_records = 0
+    for record in records:
+        if record["id"] in written_ids:
+            continue
+        written_ids.add(record["id"])
+
+        if num_records % shard_size == 0:
+            if shard_file is not None:
+                if frame:
+                    write_frame()
+                shard_file.close()
+            shards.append(f"shard-{len(shards):05d}.jsonl.zst")
+            shard_file = open(os.path.join(partial_store_dir, shards[-1]), "wb")
+
+        frame.append(record)
+        num_records += 1
+        if len(frame) == frame_size:
+            write_frame()
+
+    if shard_file is not None:
+        if frame:
+            write_frame()
+        shard_file.close()
+
+    with open(os.path.join(partial_store_dir, INDEX_FILENAME), "w") as index_file:
+        json.dump(
+            {
+                "shards": shards,
+                "records": [[record_id, *entry] for record_id, entry in index.items()],
+            },
+            index_file,
+        )
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(partial_store_dir, store_dir)
+
+    return num_records
+
+
+class ResponseStore:
+    """Reads a response store, streaming all of its records or looking up the
+    record of an id through the index."""
+
+    def __init__(self, store_dir, num_cached_frames=16):
+        self._store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILENAME)) as index_file:
+            index = json.load(index_file)
+        self._shards = index["shards"]
+        self._index = {record[0]: record[1:] for record in index["records"]}
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._frames = OrderedDict()
+        self._num_cached_frames = num_cached_frames
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, example_id):
+        return example_id in self._index
+
+    def __iter__(self):
+        """Yields the records in the order they were written."""
+        for shard in self._shards:
+            with open(os.path.join(self._store_dir, shard), "rb") as shard_file:
+                # The frames of a shard decompress as a single stream
+                reader = self._decompressor.stream_reader(
+                    shard_file, read_across_frames=True
+                )
+                for line in io.TextIOWrapper(reader, encoding="utf-8"):
+                    yield json.loads(line)
+
+    def get(self, example_id):
+        """Returns the record of an id, decompressing only its frame."""
+        shard_index, offset, length, line = self._index[example_id]
+
+        frame_key = (shard_index, offset)
+        lines = self._frames.get(frame_key)
+        if lines is None:
+            with open(
+                os.path.join(self._store_dir, self._shards[shard_index]), "rb"
+            ) as shard_file:
+                shard_file.seek(offset)
+                lines = (
+                    self._decompressor.decompress(shard_file.read(length))
+                    .decode()
+                    .splitlines()
+                )
+            self._frames[frame_key] = lines
+            if len(self._frames) > self._num_cached_frames:
+                self._frames.popitem(last=False)
+        else:
+            self._frames.move_to_end(frame_key)
+
+        return json.loads(lines[line])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert Gemini responses into a compact response store"
+    )
+    parser.add_argument(
+        "gemini_data_path",
+        type=str,
+        help="Path to the Gemini responses JSON file, or its .jsonl journal",
+    )
+    parser.add_argument("store_dir", type=str, help="Output response store directory")
+    parser.add_argument(
+        "--gemini_model",
+        type=str,
+        default="gemini-1.5-pro-001",
+        help="Model of the responses. Default: gemini-1.5-pro-001",
+    )
+    args = parser.parse_args()
+
+    gen_data = (
+        read_journal(args.gemini_data_path)
+        if args.gemini_data_path.endswith(".jsonl")
+        else read_json_array(args.gemini_data_path)
+    )
+    num_records = write_response_store(
+        (
+            compact_response(r["example"]["id"], args.gemini_model, r["response"])
+            for r in gen_data
+        ),
+        args.store_dir,
+    )
+    print(f"Wrote {num_records} records to {args.store_dir}")
@@ -0,0 +1,128 @@
+"""Retry policy of the Gemini requests, depending on the class of their errors.
+
+- quota: the request was rejected by a rate limit (HTTP 429). It is retried
+  after the Retry-After delay of the error if it has one, or else after a long
+  backoff, and gets more attempts since it will eventually go through.
+- transient: the service or the connection failed (HTTP 408 and 5xx, timeouts
+  and network errors). It is retried with a short jittered exponential backoff.
+- permanent: the request itself is invalid (other HTTP 4xx), or any other
+  error, such as a bug in a backend or in the handling of its responses. It is
+  never retried and goes to the dead-letter file.
+
+Errors are classified by their HTTP status, the `code` of the google.api_core
+exceptions or the `status_code` of HTTP client errors, so that the policy does
+not depend on the client library of a backend.
+"""
+
+import asyncio
+import email.utils
+import random
+import time
+
+QUOTA = "quota"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+ERROR_CLASSES = (QUOTA, TRANSIENT, PERMANENT)
+
+TRANSIENT_STATUS_CODES = {408, 500, 502, 503, 504}
+
+# Errors without a status which are retried, ConnectionError and TimeoutError
+# being OSErrors
+TRANSIENT_EXCEPTIONS = (OSError, asyncio.TimeoutError)
+
+
+def error_status_code(exception):
+    """Returns the HTTP status of an exception, if it has one."""
+    for attribute in ("code", "status_code"):
+        status_code = getattr(exception, attribute, None)
+        if isinstance(status_code, int):
+            return int(status_code)
+
+    response = getattr(exception, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code
+
+    return None
+
+
+def classify_error(exception):
+    """Returns the class of the error raised by a request."""
+    status_code = error_status_code(exception)
+
+    if status_code == 429:
+        return QUOTA
+    if status_code in TRANSIENT_STATUS_CODES:
+        return TRANSIENT
+    if status_code is not None:
+        return PERMANENT if 400 <= status_code < 500 else TRANSIENT
+    if isinstance(exception, TRANSIENT_EXCEPTIONS):
+        return TRANSIENT
+    return PERMANENT
+
+
+def retry_after_sec(exception):
+    """Returns the delay in seconds asked by the Retry-After header of an
+    error, if it has one."""
+    retry_after = getattr(exception, "retry_after", None)
+
+    if retry_after is None:
+        headers = getattr(getattr(exception, "response", None), "headers", None)
+        if headers is not None:
+            retry_after = headers.get("Retry-After")
+
+    if retry_after is None:
+        return None
+
+    try:
+        return max(float(retry_after), 0)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    return max(retry_date.timestamp() - time.time(), 0)
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_retries=5,
+        max_quota_retries=20,
+        base_delay_sec=1.0,
+        quota_base_delay_sec=10.0,
+        max_delay_sec=120.0,
+    ):
+        self._max_retries = max_retries
+        self._max_quota_retries = max_quota_retries
+        self._base_delay_sec = base_delay_sec
+        self._quota_base_delay_sec = quota_base_delay_sec
+        self._max_delay_sec = max_delay_sec
+
+    def retry_delay(self, exception, error_class, attempt):
+        """Returns the seconds to wait before retrying a request which failed
+        after `attempt` retries, or None when it must not be retried."""
+        if error_class == PERMANENT:
+            return None
+
+        max_retries = (
+            self._max_quota_retries if error_class == QUOTA else self._max_retries
+        )
+        if attempt >= max_retries:
+            return None
+
+        retry_after = retry_after_sec(exception)
+        if retry_after is not None:
+            return min(retry_after, self._max_delay_sec)
+
+        base_delay_sec = (
+            self._quota_base_delay_sec if error_class == QUOTA else self._base_delay_sec
+        )
+        delay = min(base_delay_sec * 2**attempt, self._max_delay_sec)
+
+        # Half of the delay is jittered, so that the requests failing together
+        # are not retried together
+        return delay / 2 + random.uniform(0, delay / 2)
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from journal import read_json_array
+
+RECORDS = [
+    1,
+    23,
+    -4.5e6,
+    'a string, with ] and "quotes"',
+    {"id": 123456, "response": {"text": "Category: world knowledge"}},
+    [7, 89, None],
+    True,
+    0.125,
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 17, 1024])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_read_json_array_across_chunks(tmp_path, chunk_size, indent):
+    json_path = tmp_path / "records.json"
+    json_path.write_text(json.dumps(RECORDS, indent=indent))
+
+    assert list(read_json_array(json_path, chunk_size)) == RECORDS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 17])
+def test_read_json_array_numbers_cut_by_chunks(tmp_path, chunk_size):
+    json_path = tmp_path / "numbers.json"
+    json_path.write_text("[1, 23, 456789, 1.5e3]")
+
+    assert list(read_json_array(json_path, chunk_size)) == [1, 23, 456789, 1500.0]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4])
+def test_read_json_array_empty(tmp_path, chunk_size):
+    json_path = tmp_path / "empty.json"
+    json_path.write_text("[ ]")
+
+    assert list(read_json_array(json_path, chunk_size)) == []
+
+
+def test_read_json_array_truncated(tmp_path):
+    json_path = tmp_path / "truncated.json"
+    json_path.write_text('[{"id": 1}, {"id": ')
+
+    with pytest.raises(ValueError):
+        list(read_json_array(json_path, 4))
@@ -1,10 +1,16 @@
 import argparse
+import csv
 import glob
 import json
 import multiprocessing
+import multiprocessing.util
 import os
+import queue
 import random
-from collections import Counter
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict
 from copy import deepcopy
 from functools import partial
 
@@ -16,11 +22,145 @@ from habitat_sim.nav import ShortestPath
 from habitat_sim.utils.settings import default_sim_settings, make_cfg
 from tqdm import tqdm
 
+reuse_simulator = False
+worker_generator = None
+
+
+class BackgroundVideoWriter:
+    """Encodes the RGB(A) frames written to it in a background thread, so that
+    the simulator renders the next frames meanwhile.
+
+    The frames go through a queue of at most queue_size frames, which blocks
+    the writer when the encoder falls behind. The mp4v codec is encoded with
+    OpenCV, and any other codec, e.g. libx264, with an ffmpeg process reading
+    the raw frames from a pipe.
+    """
+
+    def __init__(
+        self,
+        video_filename,
+        frame_size,
+        fps=30,
+        codec="mp4v",
+        preset=None,
+        crf=None,
+        ffmpeg_binary="ffmpeg",
+        queue_size=64,
+    ):
+        self._video_filename = video_filename
+        self._frame_size = frame_size
+        self._fps = fps
+        self._codec = codec
+        self._preset = preset
+        self._crf = crf
+        self._ffmpeg_binary = ffmpeg_binary
+
+        self._frames = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._encode, daemon=True)
+        self._thread.start()
+
+    def _start_ffmpeg(self, num_channels):
+        width, height = self._frame_size
+        ffmpeg_args = [
+            self._ffmpeg_binary,
+            "-v",
+            "error",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgba" if num_channels == 4 else "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(self._fps),
+            "-i",
+            "-",
+            "-c:v",
+            self._codec,
+        ]
+        if self._preset is not None:
+            ffmpeg_args += ["-preset", self._preset]
+        if self._crf is not None:
+            ffmpeg_args += ["-crf", str(self._crf)]
+        ffmpeg_args += ["-pix_fmt", "yuv420p", self._video_filename]
+
+        return subprocess.Popen(ffmpeg_args, stdin=subprocess.PIPE)
+
+    def _encode(self):
+        writer = None
+        encoder = None
+
+        try:
+            while True:
+                frame = self._frames.get()
+                if frame is None:
+                    break
+
+                if self._codec == "mp4v":
+                    if writer is None:
+                        writer = cv2.VideoWriter(
+                            self._video_filename,
+                            cv2.VideoWriter_fourcc(*"mp4v"),
+                            self._fps,
+                            self._frame_size,
+                        )
+                    writer.write(
+                        cv2.cvtColor(
+                            frame,
+                            (
+                                cv2.COLOR_RGBA2BGR
+                                if frame.shape[2] == 4
+                                else cv2.COLOR_RGB2BGR
+                            ),
+                        )
+                    )
+                else:
+                    if encoder is None:
+                        encoder = self._start_ffmpeg(frame.shape[2])
+                    encoder.stdin.write(frame.tobytes())
+        except Exception as e:
+            self._error = e
+            # Unblocks the writer, whose frames are now dropped
+            while self._frames.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.release()
+            if encoder is not None:
+                try:
+                    encoder.stdin.close()
+                except BrokenPipeError:
+                    # ffmpeg exited early, its exit code reports the failure
+                    pass
+                if encoder.wait() != 0 and self._error is None:
+                    self._error = RuntimeError(
+                        f"ffmpeg failed to encode {self._video_filename}"
+                    )
+
+    def write(self, frame):
+        """Queues a frame, which must not be modified afterwards."""
+        self._frames.put(frame)
+
+    def close(self):
+        """Waits for the queued frames to be encoded, and raises the error of the
+        encoder if it failed."""
+        self._frames.put(None)
+        self._thread.join()
+
+        if self._error is not None:
+            raise self._error
+
 
 class HabitatDataGenerator:
-    def __init__(self, scene_dataset_config_filename, scene_filename):
+    def __init__(
+        self, scene_dataset_config_filename, scene_filename, num_navigable_points=1000
+    ):
         self._scene_dataset_config_filename = scene_dataset_config_filename
         self._scene_filename = scene_filename
+        self._num_navigable_points = num_navigable_points
+        self._sim = None
 
         self._init_simulator()
 
@@ -37,32 +177,70 @@ class HabitatDataGenerator:
         self._settings = settings
         self._cfg = make_cfg(settings)
 
-        self._sim = habitat_sim.Simulator(self._cfg)
+        if self._sim is None:
+            self._sim = habitat_sim.Simulator(self._cfg)
+        else:
+            # Only the scene is loaded again, the GL context and the renderer
+            # are kept
+            self._sim.reconfigure(self._cfg)
 
         random.seed(42)
         self._sim.seed(42)
+        self._rng = np.random.default_rng(42)
+        # Sampled again for every scene
+        self._navigable_points = None
+
+    def set_scene(self, scene_dataset_config_filename, scene_filename):
+        """Switches the simulator to another scene, as a new generator would."""
+        self._scene_dataset_config_filename = scene_dataset_config_filename
+        self._scene_filename = scene_filename
+
+        self._init_simulator()
+
+    def _get_navigable_points(self):
+        """Returns the ground floor navigable points of the scene, sampled once and
+        shared by all of its objects."""
+        if self._navigable_points is None:
+            points = np.array(
+                [
+                    self._sim.pathfinder.get_random_navigable_point()
+                    for _ in range(self._num_navigable_points)
+                ],
+                dtype=np.float32,
+            ).reshape(-1, 3)
+            # Failed samples are NaN
+            self._navigable_points = points[
+                np.isfinite(points).all(axis=1) & (points[:, 1] <= 0.5)
+            ]
+
+        return self._navigable_points
 
     def _init_agent_state(self, agent_id, goal_position, min_distance):
         # Initialize the agent at a random start state
         agent = self._sim.initialize_agent(agent_id)
         start_state = agent.get_state()
 
-        num_start_tries = 0
-        while (
-            start_state.position[1] > 0.5
-            or self._compute_shortest_path(
-                start_state.position, goal_position
+        points = self._get_navigable_points()
+
+        # The geodesic distance is at least the Euclidean one, so only the points
+        # at least min_distance away in a straight line can be far enough
+        distances = np.linalg.norm(
+            points - np.asarray(goal_position, dtype=np.float32), axis=1
+        )
+        candidates = self._rng.permutation(np.flatnonzero(distances >= min_distance))
+
+        for index in candidates[:100]:
+            geodesic_distance = self._compute_shortest_path(
+                points[index], goal_position
             ).geodesic_distance
-            < min_distance
-        ) and num_start_tries < 100:
-            start_state.position = self._sim.pathfinder.get_random_navigable_point()
-            num_start_tries += 1
-        agent.set_state(start_state)
 
-        if num_start_tries == 100:
-            return None
+            # The distance is infinite when the goal cannot be reached
+            if np.isfinite(geodesic_distance) and geodesic_distance >= min_distance:
+                start_state.position = points[index]
+                agent.set_state(start_state)
+                return start_state
 
-        return start_state
+        return None
 
     def _compute_shortest_path(self, start_pos, end_pos):
         shortest_path = ShortestPath()
@@ -71,7 +249,9 @@ class HabitatDataGenerator:
         self._sim.pathfinder.find_path(shortest_path)
         return shortest_path
 
-    def generate_video(self, goal_position, video_filename, min_distance=10):
+    def generate_video(
+        self, goal_position, video_filename, min_distance=10, video_writer_options=None
+    ):
         agent_id = self._settings["default_agent"]
 
         start_state = self._init_agent_state(agent_id, goal_position, min_distance)
@@ -89,54 +269,67 @@ class HabitatDataGenerator:
         if not action_path:
             return False
 
-        # Assuming you have a list of preprocessed images (tensors) in 'images'
-        writer = cv2.VideoWriter(
+        # The frames are encoded in the background while the next ones render
+        writer = BackgroundVideoWriter(
             video_filename,
-            cv2.VideoWriter_fourcc(*"mp4v"),
-            30,
-            # (640, 480),
             (self._settings["width"], self._settings["height"]),
-        )  # Adjust codec and frame size
-
-        for action in action_path:
-            if action is None:
-                continue
-
-            observation = self._sim.step(action)
+            fps=30,
+            **(video_writer_options or {}),
+        )
 
-            color_obs = observation["color_sensor"]
+        try:
+            for action in action_path:
+                if action is None:
+                    continue
 
-            frame = cv2.cvtColor(color_obs, cv2.COLOR_RGB2BGR)
-            writer.write(frame)
+                observation = self._sim.step(action)
 
-        writer.release()
+                # The sensor buffer is rendered into again by the next step
+                writer.write(np.array(observation["color_sensor"], copy=True))
+        finally:
+            writer.close()
 
         return True
 
-    def get_relevant_objects(self, openeqa_objects_counter: Counter, max_num_objects):
-        scene_specific_objects = [
-            x
-            for x in self._sim.semantic_scene.objects
-            if x.category.name() in openeqa_objects_counter
-        ]
-
-        if len(scene_specific_objects) <= max_num_objects:
-            return scene_specific_objects
-
-        # Otherwise we have to sample following the distributiion of the OpenEQA data
-        total_mass = sum(
-            openeqa_objects_counter[x.category.name()] for x in scene_specific_objects
+    def get_relevant_objects(self, openeqa_objects_counter: Counter):
+        """Returns the objects of the scene in the OpenEQA categories, grouped by
+        category, in the order in which their videos are generated.
+
+        The categories are sampled without replacement following the
+        distribution of the OpenEQA data, weighing every object with the frequency
+        of its category, and the objects of a category are shuffled. Only one
+        video is generated per category, so its objects are alternatives when
+        one cannot be reached."""
+        category2objects = {}
+        for x in self._sim.semantic_scene.objects:
+            if x.category.name() in openeqa_objects_counter:
+                category2objects.setdefault(x.category.name(), []).append(x)
+
+        if not category2objects:
+            return []
+
+        categories = list(category2objects)
+        weights = np.array(
+            [
+                openeqa_objects_counter[category] * len(category2objects[category])
+                for category in categories
+            ],
+            dtype=np.float64,
+        )
+        order = self._rng.choice(
+            len(categories),
+            size=len(categories),
+            replace=False,
+            p=weights / weights.sum(),
         )
 
-        weights = []
-        values = []
-
-        for obj in scene_specific_objects:
-            values.append(obj)
-            obj_freq = openeqa_objects_counter[obj.category.name()]
-            weights.append(obj_freq / total_mass)
-
-        return np.random.choice(values, size=max_num_objects, p=weights).tolist()
+        return [
+            [
+                category2objects[categories[i]][j]
+                for j in self._rng.permutation(len(category2objects[categories[i]]))
+            ]
+            for i in order
+        ]
 
     def close(self):
         self._sim.close()
@@ -155,12 +348,39 @@ def generate_caption(category_name):
     return random.choice(templates).format(category_name)
 
 
+def init_worker(worker_reuse_simulator=False):
+    """Sets whether the current process keeps one simulator for all of its scenes."""
+    global reuse_simulator
+
+    reuse_simulator = worker_reuse_simulator
+
+
+def get_generator(scene, num_navigable_points=1000):
+    """Returns the generator of a scene, which is the one of the current process
+    switched to the scene when reusing the simulator."""
+    global worker_generator
+
+    if not reuse_simulator:
+        return HabitatDataGenerator(scene[0], scene[1], num_navigable_points)
+
+    if worker_generator is None:
+        worker_generator = HabitatDataGenerator(
+            scene[0], scene[1], num_navigable_points
+        )
+        # Closed when the worker process exits
+        multiprocessing.util.Finalize(
+            worker_generator, worker_generator.close, exitpriority=10
+        )
+    else:
+        worker_generator.set_scene(scene[0], scene[1])
+
+    return worker_generator
+
+
 def generate_videos_from_scene(args, openeqa_objects_counter: Counter, scene):
-    generator = HabitatDataGenerator(scene[0], scene[1])
+    generator = get_generator(scene, args.num_navigable_points)
 
-    relevant_objects = generator.get_relevant_objects(
-        openeqa_objects_counter, args.max_num_objects
-    )
+    relevant_objects = generator.get_relevant_objects(openeqa_objects_counter)
 
     return_values = []
     scene_name = scene[1].split("/")[-1].replace(".glb", "")
@@ -168,24 +388,123 @@ def generate_videos_from_scene(args, openeqa_objects_counter: Counter, scene):
 
     os.makedirs(scene_dirname, exist_ok=True)
 
-    for object in relevant_objects:
-        goal_position = object.aabb.center
-        object_name = object.category.name()
+    for category_objects in relevant_objects:
+        if len(return_values) == args.max_num_objects:
+            break
+
+        object_name = category_objects[0].category.name()
         video_filename = os.path.join(scene_dirname, f"object_{object_name}.mp4")
 
-        if generator.generate_video(goal_position, video_filename):
-            caption = generate_caption(object.category.name())
+        # The next object of the category is tried when the video of one cannot
+        # be generated, which is known before rendering it
+        for object in category_objects:
+            goal_position = object.aabb.center
+
+            if generator.generate_video(
+                goal_position,
+                video_filename,
+                video_writer_options={
+                    "codec": args.video_codec,
+                    "preset": args.video_preset,
+                    "crf": args.video_crf,
+                    "ffmpeg_binary": args.ffmpeg_binary,
+                    "queue_size": args.frame_queue_size,
+                },
+            ):
+                caption = generate_caption(object_name)
 
-            relative_video_filename = os.path.join(
-                *video_filename.split(os.path.sep)[-3:]
-            )
-            return_values.append((relative_video_filename, caption))
+                relative_video_filename = os.path.join(
+                    *video_filename.split(os.path.sep)[-3:]
+                )
+                return_values.append((relative_video_filename, caption))
+                break
 
-    generator.close()
+    if not reuse_simulator:
+        generator.close()
 
     return return_values
 
 
+def generate_videos_from_scene_timed(args, openeqa_objects_counter: Counter, scene):
+    """Generates the videos of a scene, also returning the process that generated
+    them and how long it took."""
+    start_time = time.perf_counter()
+    return_values = generate_videos_from_scene(args, openeqa_objects_counter, scene)
+
+    return os.getpid(), time.perf_counter() - start_time, return_values
+
+
+def scan_scene(scene_file):
+    """Returns the size of the meshes of a scene and the object categories of its
+    semantic annotations, read from its .semantic.txt file."""
+    semantic_file = scene_file.replace(".glb", ".semantic.glb")
+    size = os.path.getsize(scene_file) + os.path.getsize(semantic_file)
+
+    # e.g. train/00800-TEEsavR23oF/TEEsavR23oF.basis.glb
+    scene_id = os.path.basename(scene_file).split(".")[0]
+    annotations_file = os.path.join(
+        os.path.dirname(scene_file), f"{scene_id}.semantic.txt"
+    )
+
+    categories = []
+    if os.path.exists(annotations_file):
+        with open(annotations_file, newline="") as in_file:
+            reader = csv.reader(in_file)
+            # The first line is the title of the annotations
+            next(reader, None)
+            # object id, hex color, "category", region id
+            categories = sorted({row[2] for row in reader if len(row) > 2})
+
+    return {"size": size, "categories": categories}
+
+
+def load_scene_scans(scenes, cache_path=None):
+    """Scans all the scenes, reusing the scans cached in cache_path of the scenes
+    unchanged since, and caches them."""
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as in_file:
+            cache = json.load(in_file)
+
+    scans = {}
+    for _, scene_file in scenes:
+        stat = os.stat(scene_file)
+        fingerprint = [stat.st_size, stat.st_mtime_ns]
+
+        scan = cache.get(scene_file)
+        if scan is None or scan["fingerprint"] != fingerprint:
+            scan = {"fingerprint": fingerprint, **scan_scene(scene_file)}
+        scans[scene_file] = scan
+
+    if cache_path is not None:
+        # Written aside and renamed, so a crash never leaves a partial cache
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with open(f"{cache_path}.part", "w") as out_file:
+            json.dump(scans, out_file)
+        os.replace(f"{cache_path}.part", cache_path)
+
+    return scans
+
+
+def schedule_scenes(scenes, scans, openeqa_objects_counter: Counter, max_num_objects):
+    """Orders the scenes from the longest to generate to the shortest, so that the
+    workers do not wait on a few large scenes at the end.
+
+    A scene costs a video per OpenEQA category of its objects, up to
+    max_num_objects, and the scenes with as many videos are ordered by the size
+    of their meshes, which takes the longest to load."""
+
+    def scene_cost(scene):
+        scan = scans[scene[1]]
+        num_videos = sum(
+            category in openeqa_objects_counter for category in scan["categories"]
+        )
+
+        return min(num_videos, max_num_objects), scan["size"]
+
+    return sorted(scenes, key=scene_cost, reverse=True)
+
+
 def find_scene_files():
     scenes = []
     scene_dataset_config_file = "hm3d_annotated_basis.scene_dataset_config.json"
@@ -222,6 +541,63 @@ if __name__ == "__main__":
         default="../output/ft_json/hm3d_captions.json",
     )
     parser.add_argument("--num_workers", default=1, type=int)
+    parser.add_argument(
+        "--num_navigable_points",
+        type=int,
+        default=1000,
+        help="Number of navigable points sampled once per scene, among which the "
+        "start positions of the agent are chosen",
+    )
+    parser.add_argument(
+        "--video_codec",
+        type=str,
+        default="mp4v",
+        help="mp4v: encoded with OpenCV, or any ffmpeg video encoder, e.g. "
+        "libx264, fed through a pipe",
+    )
+    parser.add_argument(
+        "--video_preset",
+        type=str,
+        default=None,
+        help="Preset of the ffmpeg video encoder, e.g. veryfast",
+    )
+    parser.add_argument(
+        "--video_crf",
+        type=int,
+        default=None,
+        help="Constant rate factor of the ffmpeg video encoder",
+    )
+    parser.add_argument(
+        "--ffmpeg_binary",
+        type=str,
+        default="ffmpeg",
+        help="ffmpeg executable used for the codecs other than mp4v",
+    )
+    parser.add_argument(
+        "--frame_queue_size",
+        type=int,
+        default=64,
+        help="Number of rendered frames waiting to be encoded before the "
+        "simulator waits for the encoder",
+    )
+    parser.add_argument(
+        "--scene_scan_cache_path",
+        type=str,
+        default="../output/hm3d_scene_scans.json",
+        help="Cache of the sizes and object categories of the scenes, used to "
+        "generate the longest scenes first",
+    )
+    parser.add_argument(
+        "--no_scene_scan_cache",
+        action="store_true",
+        help="Do not use the scene scan cache",
+    )
+    parser.add_argument(
+        "--reuse_simulator",
+        action="store_true",
+        help="Create a single simulator per worker process and switch it from "
+        "scene to scene, instead of creating one per scene",
+    )
     parser.add_argument("--max_num_objects", default=30, type=int)
 
     args = parser.parse_args()
@@ -259,12 +635,22 @@ if __name__ == "__main__":
     print(f"# OpenEQA objects: {len(openeqa_objects)}")
     print(openeqa_objects.most_common(10))
 
+    # Relative to the current directory rather than to the data
+    scene_scan_cache_path = (
+        None
+        if args.no_scene_scan_cache
+        else os.path.abspath(args.scene_scan_cache_path)
+    )
+
     os.chdir(args.main_data_root)
 
     scenes = find_scene_files()
 
     print(f"Found a total of {len(scenes)} scenes in the `train` folder.")
 
+    scene_scans = load_scene_scans(scenes, scene_scan_cache_path)
+    scenes = schedule_scenes(scenes, scene_scans, openeqa_objects, args.max_num_objects)
+
     dataset = []
 
     prompts = [
@@ -280,14 +666,23 @@ if __name__ == "__main__":
         "What is the main focus of the video?",
     ]
 
-    with multiprocessing.Pool(args.num_workers) as pool:
+    worker_times = defaultdict(float)
+    start_time = time.perf_counter()
+
+    with multiprocessing.Pool(
+        args.num_workers, initializer=init_worker, initargs=(args.reuse_simulator,)
+    ) as pool:
         with tqdm(total=len(scenes)) as progress_bar:
-            for idx, return_values in enumerate(
+            # The scenes are handed out one at a time in the scheduled order
+            for idx, (worker_pid, scene_time, return_values) in enumerate(
                 pool.imap_unordered(
-                    partial(generate_videos_from_scene, args, openeqa_objects), scenes
+                    partial(generate_videos_from_scene_timed, args, openeqa_objects),
+                    scenes,
+                    chunksize=1,
                 )
             ):
                 progress_bar.update(1)
+                worker_times[worker_pid] += scene_time
 
                 for video_filename, caption in return_values:
                     prompt = random.choice(prompts)
@@ -306,5 +701,22 @@ if __name__ == "__main__":
                         }
                     )
 
+        # Leaving the block terminates the workers, so they are first let exit
+        # normally, which closes their reused simulators
+        pool.close()
+        pool.join()
+
+    wall_time = time.perf_counter() - start_time
+    total_time = sum(worker_times.values())
+    print(
+        f"Generated the scenes in {wall_time:.0f}s, for {total_time:.0f}s of work "
+        f"({total_time / args.num_workers:.0f}s per worker)"
+    )
+    for worker_pid, worker_time in sorted(worker_times.items()):
+        print(
+            f"Worker {worker_pid}: busy {worker_time:.0f}s, "
+            f"utilisation {worker_time / wall_time:.1%}"
+        )
+
     with open(args.annotations_filename, "w") as out_file:
         json.dump(dataset, out_file)